@@ -464,6 +464,11 @@ class parser(object):
         except ConfigParser.NoOptionError:
             pass
 
+        try:
+            rpki.x509.DER_object.auto_update_interval = self.getint("auto_update_interval")
+        except ConfigParser.NoOptionError:
+            pass
+
         try:
             rpki.x509.XML_CMS_object.dump_outbound_cms = rpki.x509.DeadDrop(
                 self.get("dump_outbound_cms"))
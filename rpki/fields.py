@@ -31,6 +31,7 @@ from django.db import models
 
 import rpki.x509
 import rpki.sundial
+import rpki.POW
 
 logger = logging.getLogger(__name__)
 
@@ -86,6 +87,70 @@ class SundialField(models.DateTimeField):
             return value
 
 
+class IPAddressField(models.CharField):
+    """
+    Field class for rpki.POW.IPAddress, stored as zero-padded
+    hexadecimal so lexicographic order is identical to numeric order.
+    """
+
+    # Django's CharField type doesn't distinguish between the length
+    # of the human readable form and the length of the storage form,
+    # so we have to leave room for IPv6 punctuation even though we
+    # only store hexadecimal digits and thus will never use the full
+    # width of the database field.  Price we pay for portability.
+    #
+    # Documentation on the distinction between the various conversion
+    # methods is fairly opaque, to put it politely, and we have to
+    # handle database engines which sometimes return buffers or other
+    # classes instead of strings, so the conversions are a bit
+    # finicky.  If this goes haywire, your best bet is probably to
+    # litter the code with logging.debug() calls and debug by printf.
+
+    description = "An IP address stored as zero-padded hexadecimal"
+
+    def __init__(self, *args, **kwargs):
+        kwargs["max_length"] = 40
+        super(IPAddressField, self).__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super(IPAddressField, self).deconstruct()
+        del kwargs["max_length"]
+        return name, path, args, kwargs
+
+    @staticmethod
+    def _value_to_ipaddress(value):
+        if value is None or isinstance(value, rpki.POW.IPAddress):
+            return value
+        value = str(value)
+        if ":" in value or "." in value:
+            return rpki.POW.IPAddress(value)
+        else:
+            return rpki.POW.IPAddress.fromBytes(value.decode("hex"))
+
+    def from_db_value(self, value, expression, connection, context):
+        # Can't use super() here, see Django documentation.
+        return self._value_to_ipaddress(value)
+
+    def to_python(self, value):
+        return self._value_to_ipaddress(
+            super(IPAddressField, self).to_python(value))
+
+    @staticmethod
+    def _hex_from_ipaddress(value):
+        if isinstance(value, rpki.POW.IPAddress):
+            return value.toBytes().encode("hex")
+        else:
+            return value
+
+    def get_prep_value(self, value):
+        return super(IPAddressField, self).get_prep_value(
+            self._hex_from_ipaddress(self._value_to_ipaddress(value)))
+
+    def get_db_prep_value(self, value, connection, prepared = False):
+        return self._hex_from_ipaddress(
+            super(IPAddressField, self).get_db_prep_value(value, connection, prepared))
+
+
 class BlobField(models.Field):
     """
     Old BLOB field type, predating Django's BinaryField type.
@@ -362,10 +362,8 @@ class AddNetForm(forms.Form):
             r = resource_range_ip.parse_str(address_range)
             if r.version == 6:
                 qs = models.ResourceRangeAddressV6
-                version = 'IPv6'
             else:
                 qs = models.ResourceRangeAddressV4
-                version = 'IPv4'
         except BadIPResource:
             raise forms.ValidationError('invalid IP address range')
 
@@ -377,11 +375,9 @@ class AddNetForm(forms.Form):
 
         # determine if the entered range overlaps with any prefix
         # already allocated to this child
-        for n in self.child.address_ranges.filter(version=version):
-            rng = n.as_resource_range()
-            if r.max >= rng.min and r.min <= rng.max:
-                raise forms.ValidationError(
-                    'Overlap with previous allocation to this child')
+        if self.child.address_ranges.overlapping(r).exists():
+            raise forms.ValidationError(
+                'Overlap with previous allocation to this child')
 
         return str(r)
 
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gui_rpki_cache', '0003_auto_20160420_2146'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cert',
+            name='sha256',
+            field=models.SlugField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='ghostbuster',
+            name='sha256',
+            field=models.SlugField(max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='roa',
+            name='sha256',
+            field=models.SlugField(max_length=64, null=True),
+        ),
+    ]
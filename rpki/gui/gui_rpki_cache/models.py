@@ -50,6 +50,10 @@ class SignedObject(models.Model):
     # Duplicate of rpki.rcynicdb.models.RPKIObject
     uri = models.TextField()
 
+    # hex SHA-256 of the DER, matching rpki.rcynicdb.models.RPKIObject, so
+    # that cache imports can tell which objects are new or gone
+    sha256 = models.SlugField(max_length=64, null=True)
+
     # validity period from EE cert which signed object
     not_before = models.DateTimeField()
     not_after = models.DateTimeField()
@@ -41,154 +41,283 @@ import rpki.left_right
 import rpki.gui.app.timestamp
 from rpki.gui.app.models import Conf, Alert
 from rpki.gui.gui_rpki_cache import models
+from rpki.gui.routeview.util import update_validation_status
 from rpki.irdb.zookeeper import Zookeeper
 
 from lxml.etree import Element, SubElement
 
 
-def process_certificate(auth, obj):
-    cert = models.Cert.objects.filter(ski=obj.ski).first()
-    if cert:
-        logger.debug('cache hit for CA cert uri=%s ski=%s' % (cert.uri, cert.ski))
-        return cert # cache hit
+# Batch size for bulk inserts and for pk__in lookups during cache import.
+batch_size = 500
 
-    logger.debug('parsing cert at %s' % (obj.uri,))
 
-    """Process Resource CA Certificates"""
+def in_batches(seq):
+    seq = list(seq)
+    for i in xrange(0, len(seq), batch_size):
+        yield seq[i:i + batch_size]
+
+
+def fetch_objects(pks):
+    """Load RPKIObjects (including DER) for the given primary keys."""
+
+    for chunk in in_batches(pks):
+        for obj in rpki.rcynicdb.models.RPKIObject.objects.filter(pk__in=chunk):
+            yield obj
+
+
+def range_pks(model, fields, wanted):
+    """Return a dict mapping keys to primary keys for rows of `model`, where
+    a key is the tuple of str() of the values of `fields`.  Rows for keys in
+    `wanted` (mapping key to constructor kwargs) which don't exist yet are
+    created with bulk_create()."""
+
+    def load():
+        return dict((tuple(str(v) for v in row[1:]), row[0])
+                    for row in model.objects.values_list('pk', *fields))
+
+    existing = load()
+    missing = [model(**kwargs) for key, kwargs in wanted.iteritems() if key not in existing]
+    if missing:
+        model.objects.bulk_create(missing, batch_size=batch_size)
+        existing = load()
+    return existing
+
+
+def add_m2m(field, pairs):
+    """Bulk insert (source pk, target pk) pairs into the through table of the
+    ManyToManyField `field`."""
+
+    through = field.rel.through
+    src = field.m2m_field_name() + '_id'
+    dst = field.m2m_reverse_field_name() + '_id'
+    through.objects.bulk_create((through(**{src: a, dst: b}) for a, b in pairs),
+                                batch_size=batch_size)
+
+
+def parse_certificate(obj):
+    """Extract what we store about a resource CA certificate, or return None
+    if this is not a CA certificate (eg, a router certificate)."""
+
     x509 = rpki.POW.X509.derRead(obj.der)
 
     # ensure this is a resource CA Certificate (ignore Router certs)
     bc = x509.getBasicConstraints()
     is_ca = bc is not None and bc[0]
     if not is_ca:
-	return
-
-    # locate the parent certificate
-    if obj.aki and obj.aki != obj.ski:
-        try:
-            issuer = models.Cert.objects.get(ski=obj.aki)
-        except models.Cert.DoesNotExist:
-            # process parent cert first
-            issuer = process_certificate(auth, rpki.rcynicdb.models.RPKIObject.objects.get(ski=obj.aki, authenticated=auth))
-    else:
-        issuer = None # root
+        return None
 
     asns, v4, v6 = x509.getRFC3779()
 
-    cert = models.Cert.objects.create(
-	uri=obj.uri,
-	ski=obj.ski,
-        not_before=x509.getNotBefore(),
-        not_after=x509.getNotAfter(),
-        issuer=issuer
-    )
+    return dict(obj=obj,
+                not_before=x509.getNotBefore(),
+                not_after=x509.getNotAfter(),
+                asns=asns or (),
+                v4=v4 or (),
+                v6=v6 or ())
+
+
+def import_certificates(pks):
+    """Import new resource CA certificates.  Issuers are always created before
+    the certificates they signed."""
+
+    parsed = [p for p in (parse_certificate(obj) for obj in fetch_objects(pks)) if p is not None]
+
+    asn_keys = {}
+    v4_keys = {}
+    v6_keys = {}
+    for p in parsed:
+        if p['asns'] != 'inherit':
+            for lo, hi in p['asns']:
+                asn_keys[str(lo), str(hi)] = dict(min=lo, max=hi)
+        if p['v4'] != 'inherit':
+            for lo, hi in p['v4']:
+                v4_keys[str(lo), str(hi)] = dict(prefix_min=lo, prefix_max=hi)
+        if p['v6'] != 'inherit':
+            for lo, hi in p['v6']:
+                v6_keys[str(lo), str(hi)] = dict(prefix_min=lo, prefix_max=hi)
+
+    asn_pks = range_pks(models.ASRange, ('min', 'max'), asn_keys)
+    v4_pks = range_pks(models.AddressRange, ('prefix_min', 'prefix_max'), v4_keys)
+    v6_pks = range_pks(models.AddressRangeV6, ('prefix_min', 'prefix_max'), v6_keys)
+
+    m2m = (('asns', 'asns', asn_pks), ('v4', 'addresses', v4_pks), ('v6', 'addresses_v6', v6_pks))
+
+    # Resources of issuers, for certificates which inherit.  Filled in
+    # as we go for new certificates, and on demand for old ones.
+    resources = {}
+
+    def issuer_resources(issuer_id, kind):
+        if issuer_id not in resources:
+            cert = models.Cert.objects.get(pk=issuer_id)
+            resources[issuer_id] = dict(
+                (name, list(getattr(cert, attr).values_list('pk', flat=True)))
+                for name, attr, pk_map in m2m)
+        return resources[issuer_id][kind]
+
+    ski_map = dict(models.Cert.objects.values_list('ski', 'pk'))
+    links = dict((attr, []) for name, attr, pk_map in m2m)
+
+    pending = parsed
+    while pending:
+        deferred = []
+        for p in pending:
+            obj = p['obj']
+            if obj.ski in ski_map:
+                continue                # duplicate SKI, keep the first
+            root = not obj.aki or obj.aki == obj.ski
+            if not root and obj.aki not in ski_map:
+                deferred.append(p)
+                continue
+            cert = models.Cert.objects.create(
+                uri=obj.uri,
+                ski=obj.ski,
+                sha256=obj.sha256,
+                not_before=p['not_before'],
+                not_after=p['not_after'],
+                issuer_id=None if root else ski_map[obj.aki])
+            if root:
+                cert.issuer = cert  # self-signed
+                cert.save()
+            ski_map[obj.ski] = cert.pk
+            resources[cert.pk] = {}
+            for name, attr, pk_map in m2m:
+                if p[name] == 'inherit':
+                    pks = [] if root else issuer_resources(cert.issuer_id, name)
+                else:
+                    pks = [pk_map[str(lo), str(hi)] for lo, hi in p[name]]
+                resources[cert.pk][name] = pks
+                links[attr].extend((cert.pk, pk) for pk in pks)
+        if len(deferred) == len(pending):
+            for p in deferred:
+                logger.warning('no issuer found for cert at %s aki=%s', p['obj'].uri, p['obj'].aki)
+            break
+        pending = deferred
+
+    for name, attr, pk_map in m2m:
+        add_m2m(models.Cert._meta.get_field(attr), links[attr])
+
+
+def import_roas(pks):
+    """Import new ROAs."""
+
+    parsed = []
+    v4_keys = {}
+    v6_keys = {}
+
+    for obj in fetch_objects(pks):
+        logger.debug('parsing roa at %s' % (obj.uri,))
+        r = rpki.POW.ROA.derRead(obj.der)
+        r.verify() # required in order to extract asID
+        ee = r.certs()[0] # rpki.POW.X509
+        prefixes = r.getPrefixes()
+        v4 = [rpki.resource_set.roa_prefix_ipv4(*p) for p in prefixes[0] or ()]
+        v6 = [rpki.resource_set.roa_prefix_ipv6(*p) for p in prefixes[1] or ()]
+        for keys, roa_prefixes in ((v4_keys, v4), (v6_keys, v6)):
+            for v in roa_prefixes:
+                keys[str(v.min()), str(v.max()), str(v.max_prefixlen)] = dict(
+                    prefix_min=v.min(), prefix_max=v.max(), max_length=v.max_prefixlen)
+        parsed.append((obj, r.getASID(), ee, v4, v6))
+
+    fields = ('prefix_min', 'prefix_max', 'max_length')
+    v4_pks = range_pks(models.ROAPrefixV4, fields, v4_keys)
+    v6_pks = range_pks(models.ROAPrefixV6, fields, v6_keys)
+    ski_map = dict(models.Cert.objects.values_list('ski', 'pk'))
+
+    v4_links = []
+    v6_links = []
+
+    for obj, asid, ee, v4, v6 in parsed:
+        # Locate the Resource CA cert that issued the EE that signed this ROA
+        aki = ee.getAKI().encode('hex')
+        if aki not in ski_map:
+            logger.warning('no issuer found for roa at %s aki=%s', obj.uri, aki)
+            continue
+        roa = models.ROA.objects.create(
+            uri=obj.uri,
+            sha256=obj.sha256,
+            asid=asid,
+            not_before=ee.getNotBefore(),
+            not_after=ee.getNotAfter(),
+            issuer_id=ski_map[aki])
+        v4_links.extend((roa.pk, v4_pks[str(v.min()), str(v.max()), str(v.max_prefixlen)]) for v in v4)
+        v6_links.extend((roa.pk, v6_pks[str(v.min()), str(v.max()), str(v.max_prefixlen)]) for v in v6)
+
+    add_m2m(models.ROA._meta.get_field('prefixes'), v4_links)
+    add_m2m(models.ROA._meta.get_field('prefixes_v6'), v6_links)
+
+
+def import_ghostbusters(pks):
+    """Import new Ghostbuster records."""
+
+    ski_map = dict(models.Cert.objects.values_list('ski', 'pk'))
+    gbrs = []
+
+    for obj in fetch_objects(pks):
+        logger.debug('parsing ghostbuster at %s' % (obj.uri,))
+        g = rpki.POW.CMS.derRead(obj.der)
+        ee = g.certs()[0] # rpki.POW.X509
+        aki = ee.getAKI().encode('hex')
+        vcard = vobject.readOne(g.verify())
+
+        # Locate the Resource CA cert that issued the EE that signed this ROA
+        if aki not in ski_map:
+            logger.warning('no issuer found for ghostbuster at %s aki=%s', obj.uri, aki)
+            continue
+
+        gbrs.append(models.Ghostbuster(
+            uri=obj.uri,
+            sha256=obj.sha256,
+            issuer_id=ski_map[aki],
+            not_before=ee.getNotBefore(),
+            not_after=ee.getNotAfter(),
+            full_name = vcard.fn.value if hasattr(vcard, 'fn') else None,
+            email_address = vcard.email.value if hasattr(vcard, 'email') else None,
+            telephone = vcard.tel.value if hasattr(vcard, 'tel') else None,
+            organization = vcard.org.value[0] if hasattr(vcard, 'org') else None
+            ))
+
+    models.Ghostbuster.objects.bulk_create(gbrs, batch_size=batch_size)
 
-    if issuer is None:
-	cert.issuer = cert  # self-signed
-	cert.save()
-
-    if asns == 'inherit':
-        cert.asns.add(*issuer.asns.all())
-    elif asns:
-	for asmin, asmax in asns:
-	    asr, _ = models.ASRange.objects.get_or_create(min=asmin, max=asmax)
-	    cert.asns.add(asr)
-
-    if v4 == 'inherit':
-        cert.addresses.add(*issuer.addresses.all())
-    elif v4:
-	for v4min, v4max in v4:
-	    pfx, _ = models.AddressRange.objects.get_or_create(prefix_min=v4min, prefix_max=v4max)
-	    cert.addresses.add(pfx)
-
-    if v6 == 'inherit':
-        cert.addresses_v6.add(*issuer.addresses_v6.all())
-    elif v6:
-	for v6min, v6max in v6:
-	    pfx, _ = models.AddressRangeV6.objects.get_or_create(prefix_min=v6min, prefix_max=v6max)
-	    cert.addresses_v6.add(pfx)
-
-    return cert
-
-def process_roa(auth, obj):
-    logger.debug('parsing roa at %s' % (obj.uri,))
-
-    r = rpki.POW.ROA.derRead(obj.der)
-    r.verify() # required in order to extract asID
-    ee = r.certs()[0] # rpki.POW.X509
-    aki = ee.getAKI().encode('hex')
-
-    logger.debug('looking for ca cert with ski=%s' % (aki,))
-
-    # Locate the Resource CA cert that issued the EE that signed this ROA
-    issuer = models.Cert.objects.get(ski=aki)
-
-    roa = models.ROA.objects.create(
-	    uri=obj.uri,
-	    asid=r.getASID(),
-	    not_before=ee.getNotBefore(),
-	    not_after=ee.getNotAfter(),
-	    issuer=issuer)
-
-    prefixes = r.getPrefixes()
-    if prefixes[0]: # v4
-	for p in prefixes[0]:
-	    v = rpki.resource_set.roa_prefix_ipv4(*p)
-	    roapfx, _ = models.ROAPrefixV4.objects.get_or_create(prefix_min=v.min(), prefix_max=v.max(), max_length=v.max_prefixlen)
-	    roa.prefixes.add(roapfx)
-    if prefixes[1]: # v6
-	for p in prefixes[1]:
-	    v = rpki.resource_set.roa_prefix_ipv6(*p)
-	    roapfx, _ = models.ROAPrefixV6.objects.get_or_create(prefix_min=v.min(), prefix_max=v.max(), max_length=v.max_prefixlen)
-	    roa.prefixes_v6.add(roapfx)
-
-    return roa
-
-def process_ghostbuster(auth, obj):
-    logger.debug('parsing ghostbuster at %s' % (obj.uri,))
-    g = rpki.POW.CMS.derRead(obj.der)
-    ee = g.certs()[0] # rpki.POW.X509
-    aki = ee.getAKI().encode('hex')
-    vcard = vobject.readOne(g.verify())
-
-    # Locate the Resource CA cert that issued the EE that signed this ROA
-    issuer = models.Cert.objects.get(ski=aki)
-
-    gbr = models.Ghostbuster.objects.create(
-	    uri=obj.uri,
-	    issuer=issuer, 
-	    not_before=ee.getNotBefore(),
-	    not_after=ee.getNotAfter(),
-	    full_name = vcard.fn.value if hasattr(vcard, 'fn') else None,
-	    email_address = vcard.email.value if hasattr(vcard, 'email') else None,
-	    telephone = vcard.tel.value if hasattr(vcard, 'tel') else None,
-	    organization = vcard.org.value[0] if hasattr(vcard, 'org') else None
-	    )
-
-    return gbr
 
 @transaction.atomic
 def process_cache():
-    logger.info('processing rpki cache')
+    """Bring the GUI cache in line with the current rcynic authenticated set.
 
-    # foreign key constraints should cause all other objects to be removed
-    models.Cert.objects.all().delete()
+    Objects are identified by the SHA-256 of their DER, so only objects which
+    are new since the last import are parsed, and only objects which have
+    gone away are deleted."""
 
-    # certs must be processed first in order to build proper foreign keys for roa/gbr
-    dispatch = {
-	    '.cer': process_certificate,
-	    '.gbr': process_ghostbuster,
-	    '.roa': process_roa
-	    }
+    logger.info('processing rpki cache')
 
     auth = rpki.rcynicdb.models.Authenticated.objects.order_by('started').first()
 
-    # Resource CA Certs are processed first in order to attach ROAs and Ghostbusters
-    for suffix in ('.cer', '.roa', '.gbr'):
-        cb = dispatch[suffix]
+    # (model, suffix, importer).  Resource CA Certs are processed first in
+    # order to attach ROAs and Ghostbusters.
+    dispatch = (
+        (models.Cert, '.cer', import_certificates),
+        (models.ROA, '.roa', import_roas),
+        (models.Ghostbuster, '.gbr', import_ghostbusters),
+    )
 
-        for rpkiobj in auth.rpkiobject_set.filter(uri__endswith=suffix):
-            cb(auth, rpkiobj)
+    current = {}
+    for model, suffix, importer in dispatch:
+        current[suffix] = dict(auth.rpkiobject_set.filter(uri__endswith=suffix).values_list('sha256', 'pk'))
+
+    # Remove objects which are no longer in the authenticated set.  Deleting a
+    # certificate cascades to everything it issued, so this has to happen
+    # before we work out what is missing.
+    for model, suffix, importer in dispatch:
+        stale = [pk for pk, sha256 in model.objects.values_list('pk', 'sha256')
+                 if sha256 not in current[suffix]]
+        logger.debug('removing %d stale %s objects', len(stale), suffix)
+        for chunk in in_batches(stale):
+            model.objects.filter(pk__in=chunk).delete()
+
+    for model, suffix, importer in dispatch:
+        present = set(model.objects.values_list('sha256', flat=True))
+        new = [pk for sha256, pk in current[suffix].iteritems() if sha256 not in present]
+        logger.debug('importing %d new %s objects', len(new), suffix)
+        importer(new)
 
     # Garbage collection - remove M2M relations for certs/ROAs which no longer exist
     models.ASRange.objects.annotate(num_certs=django.db.models.Count('certs')).filter(num_certs=0).delete()
@@ -198,6 +327,9 @@ def process_cache():
     models.ROAPrefixV4.objects.annotate(num_roas=django.db.models.Count('roas')).filter(num_roas=0).delete()
     models.ROAPrefixV6.objects.annotate(num_roas=django.db.models.Count('roas')).filter(num_roas=0).delete()
 
+    # ROAs changed, so route origin validation status may have too
+    update_validation_status()
+
 
 # dict mapping resource handle to list of published objects, use for notifying objects which have become invalid
 uris = {}
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routeview', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routeorigin',
+            name='validation_status',
+            field=models.CharField(choices=[(b'valid', b'valid'), (b'invalid', b'invalid'), (b'unknown', b'unknown')], db_index=True, default=b'unknown', max_length=7),
+        ),
+        migrations.AddField(
+            model_name='routeoriginv6',
+            name='validation_status',
+            field=models.CharField(choices=[(b'valid', b'valid'), (b'invalid', b'invalid'), (b'unknown', b'unknown')], db_index=True, default=b'unknown', max_length=7),
+        ),
+    ]
@@ -15,15 +15,27 @@
 
 __version__ = '$Id$'
 
-from django.db.models import PositiveIntegerField, permalink
+from django.db.models import PositiveIntegerField, CharField, permalink
 import rpki.gui.models
 
 
+VALIDATION_STATUS_CHOICES = (
+    ('valid', 'valid'),
+    ('invalid', 'invalid'),
+    ('unknown', 'unknown'),
+)
+
+
 class RouteOrigin(rpki.gui.models.PrefixV4):
     "Represents an IPv4 BGP routing table entry."
 
     asn = PositiveIntegerField(help_text='origin AS', null=False)
 
+    # computed for the whole table by
+    # rpki.gui.routeview.util.update_validation_status()
+    validation_status = CharField(max_length=7, choices=VALIDATION_STATUS_CHOICES,
+                                  default='unknown', db_index=True)
+
     def __unicode__(self):
         return u"AS%d's route origin for %s" % (self.asn,
                                                 self.get_prefix_display())
@@ -47,13 +59,7 @@ class RouteOrigin(rpki.gui.models.PrefixV4):
     @property
     def status(self):
         "Returns the validation status of this route origin object."
-        roas = self.roas
-        # subselect exact match
-        if self.asn != 0 and roas.filter(asid=self.asn, prefixes__max_length__gte=self.prefixlen).exists():
-            return 'valid'
-        elif roas.exists():
-            return 'invalid'
-        return 'unknown'
+        return self.validation_status
 
     @permalink
     def get_absolute_url(self):
@@ -69,10 +75,20 @@ class RouteOriginV6(rpki.gui.models.PrefixV6):
 
     asn = PositiveIntegerField(help_text='origin AS', null=False)
 
+    # computed for the whole table by
+    # rpki.gui.routeview.util.update_validation_status()
+    validation_status = CharField(max_length=7, choices=VALIDATION_STATUS_CHOICES,
+                                  default='unknown', db_index=True)
+
     def __unicode__(self):
         return u"AS%d's route origin for %s" % (self.asn,
                                                 self.get_prefix_display())
 
+    @property
+    def status(self):
+        "Returns the validation status of this route origin object."
+        return self.validation_status
+
     class Meta:
         ordering = ('prefix_min', '-prefix_max')
 
@@ -13,7 +13,7 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 __version__ = '$Id$'
-__all__ = ('import_routeviews_dump')
+__all__ = ('import_routeviews_dump', 'update_validation_status')
 
 import itertools
 import os.path
@@ -29,7 +29,8 @@ from django.db import transaction
 from rpki.resource_set import resource_range_ipv4, resource_range_ipv6
 from rpki.exceptions import BadIPResource
 import rpki.gui.app.timestamp
-from rpki.gui.routeview.models import RouteOrigin
+from rpki.gui.routeview.models import RouteOrigin, RouteOriginV6
+from rpki.gui.gui_rpki_cache.models import ROAPrefixV4, ROAPrefixV6
 
 # globals
 logger = logging.getLogger(__name__)
@@ -78,6 +79,8 @@ class RouteDumpParser(object):
 
         self.cleanup()  # allow cleanup function to throw prior to COMMIT
 
+        update_validation_status()
+
         logger.info('Updating timestamp metadata...')
         rpki.gui.app.timestamp.update('bgp_v4_import')
 
@@ -177,6 +180,65 @@ class MrtDumpParser(RouteDumpParser):
             raise PipeFailed('bgpdump exited with code %d' % self.pipe.returncode)
 
 
+def _prefixlen(lo, hi, bits):
+    "Prefix length of the range [lo, hi], given as integers."
+    return bits - ((hi - lo + 1).bit_length() - 1)
+
+
+def classify_routes(route_model, roa_prefix_model, bits):
+    """Compute the validation status of every row of `route_model` against
+    the ROA prefixes in `roa_prefix_model`.  Yields (pk, status) pairs.
+
+    The ROA prefixes are loaded once into an index keyed by prefix length
+    and network address, so finding the ROAs covering a route is a handful
+    of dictionary lookups (one per distinct ROA prefix length) rather than
+    several database queries."""
+
+    index = {}
+    qs = roa_prefix_model.objects.filter(roas__isnull=False).order_by()
+    for pmin, pmax, max_length, asid in qs.values_list('prefix_min', 'prefix_max', 'max_length', 'roas__asid'):
+        lo = long(pmin)
+        plen = _prefixlen(lo, long(pmax), bits)
+        index.setdefault(plen, {}).setdefault(lo, []).append((asid, max_length))
+
+    lengths = sorted(index)
+
+    for pk, rmin, rmax, asn in route_model.objects.order_by().values_list('pk', 'prefix_min', 'prefix_max', 'asn'):
+        lo = long(rmin)
+        plen = _prefixlen(lo, long(rmax), bits)
+        status = 'unknown'
+        for length in lengths:
+            if length > plen:
+                break
+            shift = bits - length
+            roas = index[length].get(lo >> shift << shift)
+            if roas:
+                status = 'invalid'
+                if asn != 0 and any(asid == asn and max_length >= plen for asid, max_length in roas):
+                    status = 'valid'
+                    break
+        yield pk, status
+
+
+def update_validation_status():
+    """Refresh the materialized validation_status column of all route origins.
+    Called after importing a route dump or the rcynic cache."""
+
+    logger.info('Updating route origin validation status...')
+
+    for route_model, roa_prefix_model, bits in ((RouteOrigin, ROAPrefixV4, 32),
+                                                (RouteOriginV6, ROAPrefixV6, 128)):
+        changed = {'valid': [], 'invalid': []}
+        for pk, status in classify_routes(route_model, roa_prefix_model, bits):
+            if status != 'unknown':
+                changed[status].append(pk)
+
+        route_model.objects.update(validation_status='unknown')
+        for status, pks in changed.iteritems():
+            for i in xrange(0, len(pks), 500):
+                route_model.objects.filter(pk__in=pks[i:i + 500]).update(validation_status=status)
+
+
 class ProgException(Exception):
     pass
 
@@ -21,9 +21,11 @@ HTTP using Python standard libraries, for RPKI programs that don't
 need the full-blown rpki.http asynchronous code.
 """
 
+import Queue
 import logging
 import httplib
 import urlparse
+import threading
 import BaseHTTPServer
 
 logger = logging.getLogger(__name__)
@@ -73,9 +75,45 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
 
 
-def server(handlers, port, host = ""):
+class ThreadPoolHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server which hands each accepted connection to one of a fixed
+    pool of worker threads, so that one slow request doesn't hold up
+    every other client.  Handlers are responsible for their own locking
+    of shared state (replay timestamps, database updates, and so forth).
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, threads):
+        BaseHTTPServer.HTTPServer.__init__(self, server_address, RequestHandlerClass)
+        self.request_queue = Queue.Queue()
+        for i in xrange(threads):
+            t = threading.Thread(target = self.worker, name = "http-worker-%d" % i)
+            t.daemon = True
+            t.start()
+
+    def process_request(self, request, client_address):
+        self.request_queue.put((request, client_address))
+
+    def worker(self):
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        logger.exception("Unhandled exception processing request from %s:%s", *client_address[:2])
+
+
+def server(handlers, port, host = "", threads = 0):
     """
     Run an HTTP server and wait (forever) for connections.
+
+    If threads is non-zero, requests are served by a pool of that many
+    worker threads rather than one at a time by the main thread.
     """
 
     if isinstance(handlers, (tuple, list)):
@@ -87,7 +125,10 @@ def server(handlers, port, host = ""):
     class RequestHandler(HTTPRequestHandler):
         rpki_handlers = handlers
 
-    BaseHTTPServer.HTTPServer((host, port), RequestHandler).serve_forever()
+    if threads > 0:
+        ThreadPoolHTTPServer((host, port), RequestHandler, threads).serve_forever()
+    else:
+        BaseHTTPServer.HTTPServer((host, port), RequestHandler).serve_forever()
 
 
 class BadURL(Exception):
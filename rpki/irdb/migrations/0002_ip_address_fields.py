@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import rpki.fields
+import rpki.POW
+
+# Address columns used to hold presentation-format strings; they now
+# hold the zero-padded hexadecimal encoding used by IPAddressField.
+# The conversion works on raw column values so that it does not
+# depend on what the field class does with strings.
+
+address_columns = (("childnet",                ("start_ip", "end_ip")),
+                   ("eecertificaterequestnet", ("start_ip", "end_ip")),
+                   ("roarequestprefix",        ("prefix",)))
+
+def to_hex(value):
+    value = str(value)
+    if ":" in value or "." in value:
+        return rpki.POW.IPAddress(value).toBytes().encode("hex")
+    else:
+        return value
+
+def to_text(value):
+    value = str(value)
+    if ":" in value or "." in value:
+        return value
+    else:
+        return str(rpki.POW.IPAddress.fromBytes(value.decode("hex")))
+
+def convert(apps, schema_editor, func):
+    cursor = schema_editor.connection.cursor()
+    qn = schema_editor.quote_name
+    for model_name, columns in address_columns:
+        table = qn(apps.get_model("irdb", model_name)._meta.db_table)
+        cursor.execute("SELECT id, %s FROM %s" % (", ".join(qn(c) for c in columns), table))
+        rows = cursor.fetchall()
+        cursor.executemany("UPDATE %s SET %s WHERE id = %%s" % (
+            table, ", ".join("%s = %%s" % qn(c) for c in columns)),
+                           [[func(v) for v in row[1:]] + [row[0]] for row in rows])
+
+def forwards(apps, schema_editor):
+    convert(apps, schema_editor, to_hex)
+
+def backwards(apps, schema_editor):
+    convert(apps, schema_editor, to_text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('irdb', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+        migrations.AlterField(
+            model_name='childnet',
+            name='start_ip',
+            field=rpki.fields.IPAddressField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='childnet',
+            name='end_ip',
+            field=rpki.fields.IPAddressField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='eecertificaterequestnet',
+            name='start_ip',
+            field=rpki.fields.IPAddressField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='eecertificaterequestnet',
+            name='end_ip',
+            field=rpki.fields.IPAddressField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='roarequestprefix',
+            name='prefix',
+            field=rpki.fields.IPAddressField(db_index=True),
+        ),
+    ]
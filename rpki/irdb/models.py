@@ -34,7 +34,7 @@ import rpki.resource_set
 import socket
 import rpki.POW
 
-from rpki.fields import EnumField, SundialField, CertificateField, DERField, RSAPrivateKeyField, CRLField, PKCS10Field
+from rpki.fields import EnumField, SundialField, CertificateField, DERField, RSAPrivateKeyField, CRLField, PKCS10Field, IPAddressField
 
 ## @var ip_version_choices
 # Choice argument for fields implementing IP version numbers.
@@ -371,14 +371,28 @@ class ResourceSet(django.db.models.Model):
     @property
     def resource_bag(self):
         raw_asn, raw_net = self._select_resource_bag()
-        asns = rpki.resource_set.resource_set_as.from_django(
-            (a.start_as, a.end_as) for a in raw_asn)
-        ipv4 = rpki.resource_set.resource_set_ipv4.from_django(
-            (a.start_ip, a.end_ip) for a in raw_net if a.version == "IPv4")
-        ipv6 = rpki.resource_set.resource_set_ipv6.from_django(
-            (a.start_ip, a.end_ip) for a in raw_net if a.version == "IPv6")
+        return self.build_resource_bag(self.valid_until, raw_asn, raw_net)
+
+    @staticmethod
+    def build_resource_bag(valid_until, asn_rows, net_rows):
+        """
+        Build a resource_bag from (start_as, end_as) and (version,
+        start_ip, end_ip) rows.  Addresses come out of the database as
+        rpki.POW.IPAddress objects, so no string parsing is needed.
+        """
+
+        asns = rpki.resource_set.resource_set_as(
+            [rpki.resource_set.resource_range_as(s, e) for s, e in asn_rows])
+        ipv4, ipv6 = [], []
+        for version, s, e in net_rows:
+            if version == "IPv4":
+                ipv4.append(rpki.resource_set.resource_range_ipv4(s, e))
+            else:
+                ipv6.append(rpki.resource_set.resource_range_ipv6(s, e))
         return rpki.resource_set.resource_bag(
-            valid_until = self.valid_until, asn = asns, v4 = ipv4, v6 = ipv6)
+            valid_until = valid_until, asn = asns,
+            v4 = rpki.resource_set.resource_set_ipv4(ipv4),
+            v6 = rpki.resource_set.resource_set_ipv6(ipv6))
 
     # Writing of .setter method deferred until something needs it.
 
@@ -392,32 +406,45 @@ class ResourceSetASN(django.db.models.Model):
     def as_resource_range(self):
         return rpki.resource_set.resource_range_as(self.start_as, self.end_as)
 
+class ResourceSetNetQuerySet(django.db.models.QuerySet):
+    """
+    Range queries against ResourceSetNet rows, which work in SQL
+    because IPAddressField stores addresses in sortable form.
+    """
+
+    def overlapping(self, resource_range):
+        return self.filter(version = "IPv%d" % resource_range.min.version,
+                           start_ip__lte = resource_range.max,
+                           end_ip__gte = resource_range.min)
+
+    def covering(self, resource_range):
+        return self.filter(version = "IPv%d" % resource_range.min.version,
+                           start_ip__lte = resource_range.min,
+                           end_ip__gte = resource_range.max)
+
 class ResourceSetNet(django.db.models.Model):
-    start_ip = django.db.models.CharField(max_length = 40)
-    end_ip   = django.db.models.CharField(max_length = 40)
+    start_ip = IPAddressField(db_index = True)
+    end_ip   = IPAddressField(db_index = True)
     version = EnumField(choices = ip_version_choices)
 
+    objects = ResourceSetNetQuerySet.as_manager()
+
     class Meta:
         abstract = True
 
     def as_resource_range(self):
-        return rpki.resource_set.resource_range_ip.from_strings(self.start_ip, self.end_ip)
+        if self.version == "IPv4":
+            return rpki.resource_set.resource_range_ipv4(self.start_ip, self.end_ip)
+        else:
+            return rpki.resource_set.resource_range_ipv6(self.start_ip, self.end_ip)
 
 class Child(CrossCertification, ResourceSet):
     issuer = django.db.models.ForeignKey(ResourceHolderCA, related_name = "children")
     name = django.db.models.TextField(null = True, blank = True)
 
     def _select_resource_bag(self):
-        child_asn = rpki.irdb.models.ChildASN.objects.raw("""
-            SELECT *
-            FROM irdb_childasn
-            WHERE child_id = %s
-            """, [self.id])
-        child_net = list(rpki.irdb.models.ChildNet.objects.raw("""
-            SELECT *
-            FROM irdb_childnet
-            WHERE child_id = %s
-            """, [self.id]))
+        child_asn = self.asns.values_list("start_as", "end_as")
+        child_net = self.address_ranges.values_list("version", "start_ip", "end_ip")
         return child_asn, child_net
 
     class Meta:
@@ -457,33 +484,39 @@ class ROARequest(django.db.models.Model):
 
     @property
     def roa_prefix_bag(self):
-        prefixes = list(rpki.irdb.models.ROARequestPrefix.objects.raw("""
-            SELECT *
-            FROM irdb_roarequestprefix
-            WHERE roa_request_id = %s
-            """, [self.id]))
-        v4 = rpki.resource_set.roa_prefix_set_ipv4.from_django(
-            (p.prefix, p.prefixlen, p.max_prefixlen) for p in prefixes if p.version == "IPv4")
-        v6 = rpki.resource_set.roa_prefix_set_ipv6.from_django(
-            (p.prefix, p.prefixlen, p.max_prefixlen) for p in prefixes if p.version == "IPv6")
-        return rpki.resource_set.roa_prefix_bag(v4 = v4, v6 = v6)
+        return self.build_roa_prefix_bag(self.prefixes.values_list(
+            "version", "prefix", "prefixlen", "max_prefixlen"))
+
+    @staticmethod
+    def build_roa_prefix_bag(rows):
+        """
+        Build a roa_prefix_bag from (version, prefix, prefixlen,
+        max_prefixlen) rows without parsing address strings.
+        """
+
+        v4, v6 = [], []
+        for version, prefix, prefixlen, max_prefixlen in rows:
+            if version == "IPv4":
+                v4.append(rpki.resource_set.roa_prefix_ipv4(prefix, prefixlen, max_prefixlen))
+            else:
+                v6.append(rpki.resource_set.roa_prefix_ipv6(prefix, prefixlen, max_prefixlen))
+        return rpki.resource_set.roa_prefix_bag(v4 = rpki.resource_set.roa_prefix_set_ipv4(v4),
+                                                v6 = rpki.resource_set.roa_prefix_set_ipv6(v6))
 
     # Writing of .setter method deferred until something needs it.
 
 class ROARequestPrefix(django.db.models.Model):
     roa_request = django.db.models.ForeignKey(ROARequest, related_name = "prefixes")
     version = EnumField(choices = ip_version_choices)
-    prefix = django.db.models.CharField(max_length = 40)
+    prefix = IPAddressField(db_index = True)
     prefixlen = django.db.models.PositiveSmallIntegerField()
     max_prefixlen = django.db.models.PositiveSmallIntegerField()
 
     def as_roa_prefix(self):
         if self.version == 'IPv4':
-            return rpki.resource_set.roa_prefix_ipv4(rpki.POW.IPAddress(self.prefix), 
-                                                     self.prefixlen, self.max_prefixlen)
+            return rpki.resource_set.roa_prefix_ipv4(self.prefix, self.prefixlen, self.max_prefixlen)
         else:
-            return rpki.resource_set.roa_prefix_ipv6(rpki.POW.IPAddress(self.prefix), 
-                                                     self.prefixlen, self.max_prefixlen)
+            return rpki.resource_set.roa_prefix_ipv6(self.prefix, self.prefixlen, self.max_prefixlen)
 
     def as_resource_range(self):
         return self.as_roa_prefix().to_resource_range()
@@ -505,16 +538,8 @@ class EECertificateRequest(ResourceSet):
     eku    = django.db.models.TextField(null = True)
 
     def _select_resource_bag(self):
-        ee_asn = rpki.irdb.models.EECertificateRequestASN.objects.raw("""
-            SELECT *
-            FROM irdb_eecertificaterequestasn
-            WHERE ee_certificate_request_id = %s
-            """, [self.id])
-        ee_net = rpki.irdb.models.EECertificateRequestNet.objects.raw("""
-            SELECT *
-            FROM irdb_eecertificaterequestnet
-            WHERE ee_certificate_request_id = %s
-            """, [self.id])
+        ee_asn = self.asns.values_list("start_as", "end_as")
+        ee_net = self.address_ranges.values_list("version", "start_ip", "end_ip")
         return ee_asn, ee_net
 
     class Meta:
@@ -84,6 +84,10 @@ irdbd_section  = "irdbd"
 rpkid_section  = "rpkid"
 pubd_section   = "pubd"
 
+# Batch size for bulk inserts and deletes when loading CSV files.
+
+bulk_batch_size = 500
+
 # A whole lot of exceptions
 
 class HandleNotSet(Exception):          "Handle not set."
@@ -94,6 +98,17 @@ class PastExpiration(Exception):        "Expiration date has already passed."
 class CouldntFindRepoParent(Exception): "Couldn't find repository's parent."
 
 
+def delete_in_batches(model, primary_keys):
+    """
+    Delete rows of a model by primary key, bulk_batch_size at a time
+    so that we don't run into SQL parameter limits.
+    """
+
+    primary_keys = list(primary_keys)
+    for i in xrange(0, len(primary_keys), bulk_batch_size):
+        model.objects.filter(pk__in = primary_keys[i : i + bulk_batch_size]).delete()
+
+
 def B64Element(e, tag, obj, **kwargs):
     """
     Create an XML element containing Base64 encoded data taken from a
@@ -932,10 +947,26 @@ class Zookeeper(object):
             child.save()
 
 
+    def _child_ids(self, handles, ignore_missing_children):
+        """
+        Map child handles to primary keys with a single query.
+        """
+
+        child_ids = dict(self.resource_ca.children.values_list("handle", "pk"))
+        if not ignore_missing_children:
+            for handle in handles:
+                if handle not in child_ids:
+                    raise rpki.irdb.models.Child.DoesNotExist("No child with handle %s" % handle)
+        return child_ids
+
+
     @django.db.transaction.atomic
     def load_prefixes(self, csv_file, ignore_missing_children = False):
         """
         Whack IRDB to match prefixes.csv.
+
+        Reads the current state in one query and applies only the
+        difference, so unchanged ranges are left alone.
         """
 
         grouped4 = {}
@@ -947,35 +978,40 @@ class Zookeeper(object):
                 grouped[handle] = []
             grouped[handle].append(prefix)
 
-        primary_keys = []
+        child_ids = self._child_ids(set(grouped4) | set(grouped6), ignore_missing_children)
+
+        wanted = {}
 
         for version, grouped, rset in ((4, grouped4, rpki.resource_set.resource_set_ipv4),
                                        (6, grouped6, rpki.resource_set.resource_set_ipv6)):
             for handle, prefixes in grouped.iteritems():
-                try:
-                    child = self.resource_ca.children.get(handle = handle)
-                except rpki.irdb.models.Child.DoesNotExist:
-                    if not ignore_missing_children:
-                        raise
-                else:
+                if handle in child_ids:
                     for prefix in rset(",".join(prefixes)):
-                        obj = rpki.irdb.models.ChildNet.objects.get_or_create(
-                            child    = child,
-                            start_ip = str(prefix.min),
-                            end_ip   = str(prefix.max),
-                            version  = version)[0]
-                        primary_keys.append(obj.pk)
+                        wanted[child_ids[handle], "IPv%d" % version, str(prefix.min), str(prefix.max)] = prefix
+
+        existing = dict(((child_id, version, str(start_ip), str(end_ip)), pk)
+                        for pk, child_id, version, start_ip, end_ip
+                        in rpki.irdb.models.ChildNet.objects.filter(
+                            child__issuer = self.resource_ca).values_list(
+                                "pk", "child_id", "version", "start_ip", "end_ip"))
+
+        delete_in_batches(rpki.irdb.models.ChildNet,
+                          [pk for key, pk in existing.iteritems() if key not in wanted])
 
-        q = rpki.irdb.models.ChildNet.objects
-        q = q.filter(child__issuer = self.resource_ca)
-        q = q.exclude(pk__in = primary_keys)
-        q.delete()
+        rpki.irdb.models.ChildNet.objects.bulk_create(
+            (rpki.irdb.models.ChildNet(child_id = key[0], version = key[1],
+                                       start_ip = prefix.min, end_ip = prefix.max)
+             for key, prefix in wanted.iteritems() if key not in existing),
+            batch_size = bulk_batch_size)
 
 
     @django.db.transaction.atomic
     def load_asns(self, csv_file, ignore_missing_children = False):
         """
         Whack IRDB to match asns.csv.
+
+        Reads the current state in one query and applies only the
+        difference, so unchanged ranges are left alone.
         """
 
         grouped = {}
@@ -985,32 +1021,38 @@ class Zookeeper(object):
                 grouped[handle] = []
             grouped[handle].append(asn)
 
-        primary_keys = []
+        child_ids = self._child_ids(grouped, ignore_missing_children)
+
+        wanted = set()
 
         for handle, asns in grouped.iteritems():
-            try:
-                child = self.resource_ca.children.get(handle = handle)
-            except rpki.irdb.models.Child.DoesNotExist:
-                if not ignore_missing_children:
-                    raise
-            else:
+            if handle in child_ids:
                 for asn in rpki.resource_set.resource_set_as(",".join(asns)):
-                    obj = rpki.irdb.models.ChildASN.objects.get_or_create(
-                        child    = child,
-                        start_as = str(asn.min),
-                        end_as   = str(asn.max))[0]
-                    primary_keys.append(obj.pk)
+                    wanted.add((child_ids[handle], long(asn.min), long(asn.max)))
+
+        existing = dict(((child_id, long(start_as), long(end_as)), pk)
+                        for pk, child_id, start_as, end_as
+                        in rpki.irdb.models.ChildASN.objects.filter(
+                            child__issuer = self.resource_ca).values_list(
+                                "pk", "child_id", "start_as", "end_as"))
 
-        q = rpki.irdb.models.ChildASN.objects
-        q = q.filter(child__issuer = self.resource_ca)
-        q = q.exclude(pk__in = primary_keys)
-        q.delete()
+        delete_in_batches(rpki.irdb.models.ChildASN,
+                          [pk for key, pk in existing.iteritems() if key not in wanted])
+
+        rpki.irdb.models.ChildASN.objects.bulk_create(
+            (rpki.irdb.models.ChildASN(child_id = child_id, start_as = start_as, end_as = end_as)
+             for child_id, start_as, end_as in wanted if (child_id, start_as, end_as) not in existing),
+            batch_size = bulk_batch_size)
 
 
     @django.db.transaction.atomic
     def load_roa_requests(self, csv_file):
         """
         Whack IRDB to match roa.csv.
+
+        ROA requests whose ASN and prefix set are unchanged keep their
+        primary keys; only new requests are created and only vanished
+        ones are deleted.
         """
 
         grouped = {}
@@ -1022,18 +1064,14 @@ class Zookeeper(object):
                 grouped[key] = []
             grouped[key].append(pnm)
 
-        # Deleting and recreating all the ROA requests is inefficient,
-        # but rpkid's current representation of ROA requests is wrong
-        # (see #32), so it's not worth a lot of effort here as we're
-        # just going to have to rewrite this soon anyway.
+        # A ROA request is identified by its ASN and the set of
+        # (version, prefix, prefixlen, max_prefixlen) tuples it holds.
 
-        self.resource_ca.roa_requests.all().delete()
+        wanted = []
 
         for key, pnms in grouped.iteritems():
             asn, group = key
-
-            roa_request = self.resource_ca.roa_requests.create(asn = asn)
-
+            prefixes = set()
             for pnm in pnms:
                 if ":" in pnm:
                     p = rpki.resource_set.roa_prefix_ipv6.parse_str(pnm)
@@ -1041,11 +1079,46 @@ class Zookeeper(object):
                 else:
                     p = rpki.resource_set.roa_prefix_ipv4.parse_str(pnm)
                     v = 4
-                roa_request.prefixes.create(
-                    version       = v,
-                    prefix        = str(p.prefix),
-                    prefixlen     = int(p.prefixlen),
-                    max_prefixlen = int(p.max_prefixlen))
+                prefixes.add(("IPv%d" % v, str(p.prefix), int(p.prefixlen), int(p.max_prefixlen)))
+            wanted.append((long(asn), frozenset(prefixes)))
+
+        existing_prefixes = {}
+
+        for roa_request_id, version, prefix, prefixlen, max_prefixlen in \
+            rpki.irdb.models.ROARequestPrefix.objects.filter(
+                roa_request__issuer = self.resource_ca).values_list(
+                    "roa_request_id", "version", "prefix", "prefixlen", "max_prefixlen"):
+            existing_prefixes.setdefault(roa_request_id, set()).add(
+                (version, str(prefix), int(prefixlen), int(max_prefixlen)))
+
+        existing = {}
+
+        for pk, asn in self.resource_ca.roa_requests.values_list("pk", "asn"):
+            key = (long(asn), frozenset(existing_prefixes.get(pk, ())))
+            existing.setdefault(key, []).append(pk)
+
+        new_prefixes = []
+
+        for key in wanted:
+            if existing.get(key):
+                existing[key].pop()
+                continue
+            asn, prefixes = key
+            roa_request = self.resource_ca.roa_requests.create(asn = asn)
+            new_prefixes.extend(
+                rpki.irdb.models.ROARequestPrefix(
+                    roa_request   = roa_request,
+                    version       = version,
+                    prefix        = prefix,
+                    prefixlen     = prefixlen,
+                    max_prefixlen = max_prefixlen)
+                for version, prefix, prefixlen, max_prefixlen in prefixes)
+
+        delete_in_batches(rpki.irdb.models.ROARequest,
+                          [pk for pks in existing.itervalues() for pk in pks])
+
+        rpki.irdb.models.ROARequestPrefix.objects.bulk_create(new_prefixes,
+                                                             batch_size = bulk_batch_size)
 
 
     @django.db.transaction.atomic
@@ -26,6 +26,7 @@ import os
 import time
 import logging
 import argparse
+import threading
 import rpki.http_simple
 import rpki.config
 import rpki.resource_set
@@ -46,15 +47,59 @@ class main(object):
 
     debug = False
 
+    # Above this many children per tenant in one query message, it's
+    # cheaper to load resources for all of the tenant's children than
+    # to pass a long list of handles to the database.
+
+    list_resources_handle_limit = 500
+
+    def select_child_resources(self, q_msg):
+        """
+        Load resource bags for every child named in the list_resources
+        PDUs of a query message, using a constant number of queries per
+        tenant rather than several per child.  Returns a dictionary
+        mapping (tenant_handle, child_handle) to a resource_bag.
+        """
+
+        wanted = {}
+        for q_pdu in q_msg.iterchildren(rpki.left_right.tag_list_resources):
+            wanted.setdefault(q_pdu.get("tenant_handle"), set()).add(q_pdu.get("child_handle"))
+
+        bags = {}
+
+        for tenant_handle, child_handles in wanted.iteritems():
+            children = rpki.irdb.models.Child.objects.filter(issuer__handle = tenant_handle)
+            asns = rpki.irdb.models.ChildASN.objects.filter(child__issuer__handle = tenant_handle)
+            nets = rpki.irdb.models.ChildNet.objects.filter(child__issuer__handle = tenant_handle)
+            if len(child_handles) <= self.list_resources_handle_limit:
+                children = children.filter(handle__in = child_handles)
+                asns = asns.filter(child__handle__in = child_handles)
+                nets = nets.filter(child__handle__in = child_handles)
+
+            raw_asn = {}
+            raw_net = {}
+            for child_id, start_as, end_as in asns.values_list("child_id", "start_as", "end_as"):
+                raw_asn.setdefault(child_id, []).append((start_as, end_as))
+            for child_id, version, start_ip, end_ip in nets.values_list("child_id", "version", "start_ip", "end_ip"):
+                raw_net.setdefault(child_id, []).append((version, start_ip, end_ip))
+
+            for pk, child_handle, valid_until in children.values_list("pk", "handle", "valid_until"):
+                if child_handle in child_handles:
+                    bags[tenant_handle, child_handle] = rpki.irdb.models.Child.build_resource_bag(
+                        valid_until, raw_asn.get(pk, ()), raw_net.get(pk, ()))
+
+        return bags
+
     def handle_list_resources(self, q_pdu, r_msg):
         tenant_handle = q_pdu.get("tenant_handle")
         child_handle  = q_pdu.get("child_handle")
-        child  = rpki.irdb.models.Child.objects.get(issuer__handle = tenant_handle,
-                                                    handle = child_handle)
-        resources = child.resource_bag
+        try:
+            resources = self.local.child_resources[tenant_handle, child_handle]
+        except KeyError:
+            raise rpki.irdb.models.Child.DoesNotExist("No child %s for tenant %s" % (child_handle, tenant_handle))
         r_pdu = SubElement(r_msg, rpki.left_right.tag_list_resources, 
                            tenant_handle = tenant_handle, child_handle = child_handle,
-                           valid_until = child.valid_until.strftime("%Y-%m-%dT%H:%M:%SZ"))
+                           valid_until = resources.valid_until.strftime("%Y-%m-%dT%H:%M:%SZ"))
         for k, v in (("asn",  resources.asn),
                      ("ipv4", resources.v4),
                      ("ipv6", resources.v6),
@@ -121,7 +166,8 @@ class main(object):
             irdbd = serverCA.ee_certificates.get(purpose = "irdbd")
             q_cms = rpki.left_right.cms_msg(DER = q_der)
             q_msg = q_cms.unwrap((serverCA.certificate, rpkid.certificate))
-            self.cms_timestamp = q_cms.check_replay(self.cms_timestamp, request.path)
+            with self.cms_timestamp_lock:
+                self.cms_timestamp = q_cms.check_replay(self.cms_timestamp, request.path)
             if self.debug:
                 logger.debug("Received: %s", ElementToString(q_msg))
             if q_msg.get("type") != "query":
@@ -129,6 +175,7 @@ class main(object):
                     q_msg.get("type")))
             r_msg = Element(rpki.left_right.tag_msg, nsmap = rpki.left_right.nsmap,
                             type = "reply", version = rpki.left_right.version)
+            self.local.child_resources = self.select_child_resources(q_msg)
             try:
                 for q_pdu in q_msg:
                     getattr(self, "handle_" + q_pdu.tag[len(rpki.left_right.xmlns):])(q_pdu, r_msg)
@@ -178,6 +225,8 @@ class main(object):
             self.cfg.set_global_flags()
 
             self.cms_timestamp = None
+            self.cms_timestamp_lock = threading.Lock()
+            self.local = threading.local()
 
             if not args.foreground:
                 rpki.daemonize.daemon(pidfile = args.pidfile)
@@ -215,10 +264,12 @@ class main(object):
 
         self.http_server_host = self.cfg.get("server-host", "")
         self.http_server_port = self.cfg.getint("server-port")
+        self.http_server_threads = self.cfg.getint("server-threads", 0)
 
         rpki.http_simple.server(
             host     = self.http_server_host,
             port     = self.http_server_port,
+            threads  = self.http_server_threads,
             handlers = self.handler)
 
     def start_new_transaction(self):
@@ -29,6 +29,9 @@ import time
 import socket
 import logging
 import argparse
+import threading
+import contextlib
+import collections
 
 import rpki.resource_set
 import rpki.x509
@@ -117,6 +120,16 @@ class main(object):
 
         self.http_server_host = self.cfg.get("server-host", "")
         self.http_server_port = self.cfg.getint("server-port")
+        self.http_server_threads = self.cfg.getint("server-threads", 0)
+
+        # With a threaded HTTP server, these serialize replay checks for
+        # the control channel and for each client, and all updates to
+        # the publication session (database, RRDP files, rsync tree).
+
+        self.control_lock = threading.Lock()
+        self.session_lock = threading.Lock()
+        self.client_locks = collections.defaultdict(threading.Lock)
+        self.client_locks_lock = threading.Lock()
 
         self.publication_base = self.cfg.get("publication-base", "publication/")
 
@@ -132,6 +145,7 @@ class main(object):
         rpki.http_simple.server(
             host     = self.http_server_host,
             port     = self.http_server_port,
+            threads  = self.http_server_threads,
             handlers = (("/control", self.control_handler),
                         ("/client/", self.client_handler)))
 
@@ -147,7 +161,8 @@ class main(object):
             connection.cursor()           # Reconnect to mysqld if necessary
             q_cms = rpki.publication_control.cms_msg(DER = q_der)
             q_msg = q_cms.unwrap((self.bpki_ta, self.irbe_cert))
-            self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, "control")
+            with self.control_lock:
+                self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, "control")
             if q_msg.get("type") != "query":
                 raise rpki.exceptions.BadQuery("Message type is %s, expected query" % q_msg.get("type"))
             r_msg = Element(rpki.publication_control.tag_msg, nsmap = rpki.publication_control.nsmap,
@@ -155,7 +170,7 @@ class main(object):
 
             try:
                 q_pdu = None
-                with transaction.atomic():
+                with self.session_lock, transaction.atomic():
 
                     for q_pdu in q_msg:
                         if q_pdu.tag != rpki.publication_control.tag_client:
@@ -226,6 +241,31 @@ class main(object):
 
     client_url_regexp = re.compile("/client/([-A-Z0-9_/]+)$", re.I)
 
+    def client_lock(self, client_handle):
+        """
+        Return the lock which serializes requests from one client, so
+        that replay checks and updates for that client happen in order
+        even when we're running with a pool of HTTP server threads.
+        """
+
+        with self.client_locks_lock:
+            return self.client_locks[client_handle]
+
+    @contextlib.contextmanager
+    def session_lock_for(self, q_msg):
+        """
+        Hold the RRDP session lock while processing a query which
+        publishes or withdraws anything.  Queries which only list a
+        client's objects don't change the session and are already
+        serialized per client, so they don't wait for other clients.
+        """
+
+        if all(q_pdu.tag == rpki.publication.tag_list for q_pdu in q_msg):
+            yield
+        else:
+            with self.session_lock:
+                yield
+
     def client_handler(self, request, q_der):
         """
         Process one PDU from a client.
@@ -238,68 +278,70 @@ class main(object):
             match = self.client_url_regexp.search(request.path)
             if match is None:
                 raise rpki.exceptions.BadContactURL("Bad path: %s" % request.path)
-            client = rpki.pubdb.models.Client.objects.get(client_handle = match.group(1))
-            q_cms = rpki.publication.cms_msg(DER = q_der)
-            q_msg = q_cms.unwrap((self.bpki_ta, client.bpki_cert, client.bpki_glue))
-            client.last_cms_timestamp = q_cms.check_replay(client.last_cms_timestamp, client.client_handle)
-            client.save()
-            if q_msg.get("type") != "query":
-                raise rpki.exceptions.BadQuery("Message type is %s, expected query" % q_msg.get("type"))
-            r_msg = Element(rpki.publication.tag_msg, nsmap = rpki.publication.nsmap,
-                            type = "reply", version = rpki.publication.version)
-            delta = None
-            try:
-                with transaction.atomic():
-                    for q_pdu in q_msg:
-                        if q_pdu.get("uri"):
-                            logger.info("Client %s request for %s", q_pdu.tag, q_pdu.get("uri"))
+            with self.client_lock(match.group(1)):
+                client = rpki.pubdb.models.Client.objects.get(client_handle = match.group(1))
+                q_cms = rpki.publication.cms_msg(DER = q_der)
+                q_msg = q_cms.unwrap((self.bpki_ta, client.bpki_cert, client.bpki_glue))
+                client.last_cms_timestamp = q_cms.check_replay(client.last_cms_timestamp, client.client_handle)
+                client.save()
+                if q_msg.get("type") != "query":
+                    raise rpki.exceptions.BadQuery("Message type is %s, expected query" % q_msg.get("type"))
+                r_msg = Element(rpki.publication.tag_msg, nsmap = rpki.publication.nsmap,
+                                type = "reply", version = rpki.publication.version)
+                with self.session_lock_for(q_msg):
+                    delta = None
+                    try:
+                        with transaction.atomic():
+                            for q_pdu in q_msg:
+                                if q_pdu.get("uri"):
+                                    logger.info("Client %s request for %s", q_pdu.tag, q_pdu.get("uri"))
+                                else:
+                                    logger.info("Client %s request", q_pdu.tag)
+
+                                if q_pdu.tag == rpki.publication.tag_list:
+                                    for obj in client.publishedobject_set.all():
+                                        r_pdu = SubElement(r_msg, q_pdu.tag, uri = obj.uri, hash = obj.hash)
+                                        if q_pdu.get("tag") is not None:
+                                            r_pdu.set("tag", q_pdu.get("tag"))
+
+                                else:
+                                    assert q_pdu.tag in (rpki.publication.tag_publish, rpki.publication.tag_withdraw)
+                                    if delta is None:
+                                        delta = self.session.new_delta(rpki.sundial.now() + self.rrdp_expiration_interval)
+                                    client.check_allowed_uri(q_pdu.get("uri"))
+                                    if q_pdu.tag == rpki.publication.tag_publish:
+                                        der = q_pdu.text.decode("base64")
+                                        logger.info("Publishing %s", rpki.x509.uri_dispatch(q_pdu.get("uri"))(DER = der).tracking_data(q_pdu.get("uri")))
+                                        delta.publish(client, der, q_pdu.get("uri"), q_pdu.get("hash"))
+                                    else:
+                                        logger.info("Withdrawing %s", q_pdu.get("uri"))
+                                        delta.withdraw(client, q_pdu.get("uri"), q_pdu.get("hash"))
+                                    r_pdu = SubElement(r_msg, q_pdu.tag, uri = q_pdu.get("uri"))
+                                    if q_pdu.get("tag") is not None:
+                                        r_pdu.set("tag", q_pdu.get("tag"))
+
+                            if delta is not None:
+                                delta.activate(self.rrdp_publication_base)
+                                self.session.expire_deltas()
+
+                    except Exception as e:
+                        if isinstance(e, (rpki.exceptions.ExistingObjectAtURI,
+                                          rpki.exceptions.DifferentObjectAtURI,
+                                          rpki.exceptions.NoObjectAtURI)):
+                            logger.warn("Database synchronization error processing PDU %r hash %s uri %s: %s",
+                                        q_pdu, q_pdu.get("hash"), q_pdu.get("uri"), e)
                         else:
-                            logger.info("Client %s request", q_pdu.tag)
-
-                        if q_pdu.tag == rpki.publication.tag_list:
-                            for obj in client.publishedobject_set.all():
-                                r_pdu = SubElement(r_msg, q_pdu.tag, uri = obj.uri, hash = obj.hash)
-                                if q_pdu.get("tag") is not None:
-                                    r_pdu.set("tag", q_pdu.get("tag"))
-
-                        else:
-                            assert q_pdu.tag in (rpki.publication.tag_publish, rpki.publication.tag_withdraw)
-                            if delta is None:
-                                delta = self.session.new_delta(rpki.sundial.now() + self.rrdp_expiration_interval)
-                            client.check_allowed_uri(q_pdu.get("uri"))
-                            if q_pdu.tag == rpki.publication.tag_publish:
-                                der = q_pdu.text.decode("base64")
-                                logger.info("Publishing %s", rpki.x509.uri_dispatch(q_pdu.get("uri"))(DER = der).tracking_data(q_pdu.get("uri")))
-                                delta.publish(client, der, q_pdu.get("uri"), q_pdu.get("hash"))
-                            else:
-                                logger.info("Withdrawing %s", q_pdu.get("uri"))
-                                delta.withdraw(client, q_pdu.get("uri"), q_pdu.get("hash"))
-                            r_pdu = SubElement(r_msg, q_pdu.tag, uri = q_pdu.get("uri"))
-                            if q_pdu.get("tag") is not None:
-                                r_pdu.set("tag", q_pdu.get("tag"))
-
-                    if delta is not None:
-                        delta.activate(self.rrdp_publication_base)
-                        self.session.expire_deltas()
-
-            except Exception as e:
-                if isinstance(e, (rpki.exceptions.ExistingObjectAtURI,
-                                  rpki.exceptions.DifferentObjectAtURI,
-                                  rpki.exceptions.NoObjectAtURI)):
-                    logger.warn("Database synchronization error processing PDU %r hash %s uri %s: %s",
-                                q_pdu, q_pdu.get("hash"), q_pdu.get("uri"), e)
-                else:
-                    logger.exception("Exception processing PDU %r hash = %s uri = %s",
-                                     q_pdu, q_pdu.get("hash"), q_pdu.get("uri"))
-                r_pdu = SubElement(r_msg, rpki.publication.tag_report_error, error_code = e.__class__.__name__)
-                r_pdu.text = str(e)
-                if q_pdu.get("tag") is not None:
-                    r_pdu.set("tag", q_pdu.get("tag"))
-
-            else:
-                if delta is not None:
-                    self.session.synchronize_rrdp_files(self.rrdp_publication_base, self.rrdp_base_uri)
-                    delta.update_rsync_files(self.publication_base)
+                            logger.exception("Exception processing PDU %r hash = %s uri = %s",
+                                             q_pdu, q_pdu.get("hash"), q_pdu.get("uri"))
+                        r_pdu = SubElement(r_msg, rpki.publication.tag_report_error, error_code = e.__class__.__name__)
+                        r_pdu.text = str(e)
+                        if q_pdu.get("tag") is not None:
+                            r_pdu.set("tag", q_pdu.get("tag"))
+
+                    else:
+                        if delta is not None:
+                            self.session.synchronize_rrdp_files(self.rrdp_publication_base, self.rrdp_base_uri, delta)
+                            delta.update_rsync_files(self.publication_base)
 
             request.send_cms_response(rpki.publication.cms_msg().wrap(r_msg, self.pubd_key, self.pubd_cert, self.pubd_crl))
 
@@ -23,7 +23,7 @@ Django ORM models for pubd.
 from __future__ import unicode_literals
 from django.db import models
 from rpki.fields import CertificateField, SundialField
-from lxml.etree import Element, SubElement, ElementTree, xmlfile as XMLFile
+from lxml.etree import Element, SubElement, ElementTree, xmlfile as XMLFile, iterparse, XMLSyntaxError
 
 import os
 import logging
@@ -140,23 +140,90 @@ class Session(models.Model):
         return "%s/%s" % (rrdp_base_uri.rstrip("/"), fn)
 
 
-    def write_snapshot_file(self, rrdp_publication_base):
-        fn = os.path.join(rrdp_publication_base, self.snapshot_fn)
-        tn = fn + ".%s.tmp" % os.getpid()
-        dn = os.path.dirname(fn)
-        if not os.path.isdir(dn):
-            os.makedirs(dn)
+    @property
+    def previous_snapshot_fn(self):
+        return "%s/snapshot/%s.xml" % (self.uuid, self.serial - 1)
+
+
+    def _write_snapshot(self, tn, objects):
+        """
+        Write a snapshot to temporary file tn from an iterable of (uri,
+        Base64) pairs, return the hash of the resulting file.
+        """
+
         with open(tn, "wb+") as f:
             with XMLFile(f) as xf:
                 with xf.element(rrdp_tag_snapshot, nsmap = rrdp_nsmap,
                                 version = rrdp_version, session_id = self.uuid, serial = str(self.serial)):
                     xf.write("\n")
-                    for obj in self.publishedobject_set.all():
-                        e = Element(rrdp_tag_publish, nsmap = rrdp_nsmap, uri = obj.uri)
-                        e.text = rpki.x509.base64_with_linebreaks(obj.der)
+                    for uri, b64 in objects:
+                        e = Element(rrdp_tag_publish, nsmap = rrdp_nsmap, uri = uri)
+                        e.text = b64
                         xf.write(e, pretty_print = True)
             f.seek(0)
-            h = sha256_file(f)
+            return sha256_file(f)
+
+
+    def _incremental_snapshot_objects(self, fn, delta, counter):
+        """
+        Generate (uri, Base64) pairs for the current snapshot by
+        replaying a delta against the snapshot for the previous serial.
+        Objects we copy from the previous snapshot are never decoded, so
+        this costs one sequential read of the old file rather than a
+        query for and re-encoding of every published object.
+        """
+
+        changes = {}
+        for pdu in delta.xml:
+            assert pdu.tag in (rrdp_tag_publish, rrdp_tag_withdraw)
+            changes[pdu.get("uri")] = pdu.text if pdu.tag == rrdp_tag_publish else None
+        for event, elt in iterparse(fn, tag = rrdp_tag_publish):  # pylint: disable=W0612
+            uri = elt.get("uri")
+            if uri not in changes:
+                counter[0] += 1
+                yield uri, elt.text
+            elt.clear()
+            while elt.getprevious() is not None:
+                del elt.getparent()[0]
+        for uri, b64 in changes.iteritems():
+            if b64 is not None:
+                counter[0] += 1
+                yield uri, b64
+
+
+    def write_snapshot_file(self, rrdp_publication_base, delta = None):
+        """
+        Write the snapshot file for the current serial, return its hash.
+
+        If we're given the delta which got us here and the snapshot for
+        the previous serial is still on disk, we build the new snapshot
+        from those, checking the resulting object count against SQL.  If
+        anything about that goes wrong we fall back to writing the whole
+        snapshot from SQL.
+        """
+
+        fn = os.path.join(rrdp_publication_base, self.snapshot_fn)
+        pn = os.path.join(rrdp_publication_base, self.previous_snapshot_fn)
+        tn = fn + ".%s.tmp" % os.getpid()
+        dn = os.path.dirname(fn)
+        if not os.path.isdir(dn):
+            os.makedirs(dn)
+        h = None
+        if delta is not None and delta.serial == self.serial and os.path.exists(pn):
+            counter = [0]
+            try:
+                h = self._write_snapshot(tn, self._incremental_snapshot_objects(pn, delta, counter))
+            except (EnvironmentError, XMLSyntaxError):
+                logger.exception("Couldn't build snapshot %s incrementally from %s", fn, pn)
+            else:
+                expected = self.publishedobject_set.count()
+                if counter[0] != expected:
+                    logger.warning("Incremental snapshot %s has %d objects, expected %d, regenerating",
+                                   fn, counter[0], expected)
+                    h = None
+        if h is None:
+            h = self._write_snapshot(tn, ((obj.uri, rpki.x509.base64_with_linebreaks(obj.der))
+                                          for obj in self.publishedobject_set.iterator()))
         os.rename(tn, fn)
         return h
 
@@ -181,9 +248,13 @@ class Session(models.Model):
         os.rename(tn, fn)
 
 
-    def synchronize_rrdp_files(self, rrdp_publication_base, rrdp_base_uri):
+    def synchronize_rrdp_files(self, rrdp_publication_base, rrdp_base_uri, delta = None):
         """
         Write current RRDP files to disk, clean up old files and directories.
+
+        If delta is the delta which produced the current serial, we use it
+        to update the previous snapshot rather than regenerating the
+        snapshot from scratch.
         """
 
         if os.path.isdir(rrdp_publication_base):
@@ -192,7 +263,7 @@ class Session(models.Model):
         else:
             current_filenames = set()
 
-        snapshot_hash = self.write_snapshot_file(rrdp_publication_base)
+        snapshot_hash = self.write_snapshot_file(rrdp_publication_base, delta)
         current_filenames.add(self.snapshot_fn)
 
         for delta in self.delta_set.all():
@@ -238,6 +309,17 @@ class Delta(models.Model):
 
 
     def activate(self, rrdp_publication_base):
+        """
+        Validate the finished delta, write it to disk, and bump the
+        session serial.
+
+        We check the delta against the RRDP schema once here rather than
+        after every publish or withdraw: revalidating the whole document
+        as it grows is quadratic in the number of PDUs, and the
+        publication protocol schema has already checked each PDU we were
+        handed.
+        """
+
         rpki.relaxng.rrdp.assertValid(self.xml)
         fn = os.path.join(rrdp_publication_base, self.fn)
         tn = fn + ".%s.tmp" % os.getpid()
@@ -272,7 +354,6 @@ class Delta(models.Model):
         se = DERSubElement(self.xml, rrdp_tag_publish, der = der, uri = uri)
         if obj_hash is not None:
             se.set("hash", obj_hash)
-        rpki.relaxng.rrdp.assertValid(self.xml)
 
 
     def withdraw(self, client, uri, obj_hash):
@@ -285,7 +366,6 @@ class Delta(models.Model):
         logger.debug("Withdrawing %s", uri)
         obj.delete()
         SubElement(self.xml, rrdp_tag_withdraw, uri = uri, hash = obj_hash).tail = "\n"
-        rpki.relaxng.rrdp.assertValid(self.xml)
 
 
     def update_rsync_files(self, publication_base):
@@ -22,21 +22,36 @@ to what wget would use) and new style (Django ORM) databases.
 """
 
 import os
+import hashlib
 
 initialized_django = False
 
 def _uri_to_class(uri, class_map):
     return class_map[uri[uri.rindex(".")+1:]]
 
+def _default_class_map():
+    import rpki.POW
+    return dict(cer = rpki.POW.X509,
+                crl = rpki.POW.CRL,
+                gbr = rpki.POW.CMS,
+                mft = rpki.POW.Manifest,
+                roa = rpki.POW.ROA)
+
+def _latest_authenticated():
+    global initialized_django
+    if not initialized_django:
+        os.environ.update(DJANGO_SETTINGS_MODULE = "rpki.django_settings.rcynic")
+        import django
+        django.setup()
+        initialized_django = True
+
+    import rpki.rcynicdb
+    return rpki.rcynicdb.models.Authenticated.objects.order_by("-started").first()
+
 def authenticated_objects(directory_tree = None, uri_suffix = None, class_map = None):
 
     if class_map is None:
-        import rpki.POW
-        class_map = dict(cer = rpki.POW.X509,
-                         crl = rpki.POW.CRL,
-                         gbr = rpki.POW.CMS,
-                         mft = rpki.POW.Manifest,
-                         roa = rpki.POW.ROA)
+        class_map = _default_class_map()
 
     if directory_tree:
         for head, dirs, files in os.walk(directory_tree):
@@ -47,18 +62,55 @@ def authenticated_objects(directory_tree = None, uri_suffix = None, class_map =
                     yield uri, _uri_to_class(uri, class_map).derReadFile(fn)
         return
 
-    global initialized_django
-    if not initialized_django:
-        os.environ.update(DJANGO_SETTINGS_MODULE = "rpki.django_settings.rcynic")
-        import django
-        django.setup()
-        initialized_django = True
-
-    import rpki.rcynicdb
-    auth = rpki.rcynicdb.models.Authenticated.objects.order_by("-started").first()
+    auth = _latest_authenticated()
     if auth is None:
         return
     
     q = auth.rpkiobject_set
     for obj in q.filter(uri__endswith = uri_suffix) if uri_suffix else q.all():
         yield obj.uri, _uri_to_class(obj.uri, class_map).derRead(obj.der)
+
+def authenticated_digests(directory_tree = None, uri_suffix = None, class_map = None, known = ()):
+    """
+    Like authenticated_objects(), but yields (uri, sha256, obj) triples,
+    where sha256 is the hex SHA-256 digest of the object's DER and obj
+    is None for any object whose digest is in known.  This lets callers
+    which cache results derived from objects skip parsing (and, with
+    the Django database, fetching) objects they've already seen.
+    """
+
+    if class_map is None:
+        class_map = _default_class_map()
+
+    if directory_tree:
+        for head, dirs, files in os.walk(directory_tree):
+            for fn in files:
+                if uri_suffix is None or fn.endswith(uri_suffix):
+                    fn = os.path.join(head, fn)
+                    uri = "rsync://" + fn[len(directory_tree):].lstrip("/")
+                    with open(fn, "rb") as f:
+                        der = f.read()
+                    sha256 = hashlib.sha256(der).hexdigest()
+                    if sha256 in known:
+                        yield uri, sha256, None
+                    else:
+                        yield uri, sha256, _uri_to_class(uri, class_map).derRead(der)
+        return
+
+    auth = _latest_authenticated()
+    if auth is None:
+        return
+
+    q = auth.rpkiobject_set
+    if uri_suffix:
+        q = q.filter(uri__endswith = uri_suffix)
+    unknown = []
+    for uri, sha256 in q.values_list("uri", "sha256").iterator():
+        if sha256 in known:
+            yield uri, sha256, None
+        else:
+            unknown.append(sha256)
+    # Keep IN clauses below SQLite's limit on query parameters.
+    for i in xrange(0, len(unknown), 500):
+        for obj in q.filter(sha256__in = unknown[i : i + 500]):
+            yield obj.uri, obj.sha256, _uri_to_class(obj.uri, class_map).derRead(obj.der)
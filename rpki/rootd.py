@@ -26,6 +26,7 @@ import os
 import time
 import logging
 import argparse
+import threading
 
 import rpki.resource_set
 import rpki.up_down
@@ -355,8 +356,9 @@ class main(object):
                             sender  = q_msg.get("recipient"), recipient = q_msg.get("sender"),
                             type = q_type + "_response")
             try:
-                self.rpkid_cms_timestamp = q_cms.check_replay(self.rpkid_cms_timestamp, request.path)
-                getattr(self, "handle_" + q_type)(q_msg, r_msg)
+                with self.lock:
+                    self.rpkid_cms_timestamp = q_cms.check_replay(self.rpkid_cms_timestamp, request.path)
+                    getattr(self, "handle_" + q_type)(q_msg, r_msg)
             except Exception, e:
                 logger.exception("Exception processing up-down %s message", q_type)
                 rpki.up_down.generate_error_response_from_exception(r_msg, e, q_type)
@@ -397,6 +399,10 @@ class main(object):
         self.rpkid_cms_timestamp = None
         self.pubd_replay_tracker = ReplayTracker()
 
+        # Serializes replay checks and all changes to our certificates
+        # and publication state when using a threaded HTTP server.
+        self.lock = threading.Lock()
+
         os.environ["TZ"] = "UTC"
         time.tzset()
 
@@ -430,6 +436,7 @@ class main(object):
 
         self.http_server_host        = self.cfg.get("server-host", "")
         self.http_server_port        = self.cfg.getint("server-port")
+        self.http_server_threads     = self.cfg.getint("server-threads", 0)
 
         self.rpki_class_name         = self.cfg.get("rpki-class-name")
 
@@ -459,4 +466,5 @@ class main(object):
 
         rpki.http_simple.server(host     = self.http_server_host,
                                 port     = self.http_server_port,
+                                threads  = self.http_server_threads,
                                 handlers = (("/", self.handler, rpki.up_down.allowed_content_types),))
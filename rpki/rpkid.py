@@ -29,17 +29,20 @@ import logging
 import weakref
 import argparse
 import urlparse
+import collections
+import multiprocessing
 
 import tornado.gen
 import tornado.web
 import tornado.locks
+import tornado.concurrent
 import tornado.ioloop
 import tornado.queues
 import tornado.httputil
 import tornado.httpclient
 import tornado.httpserver
 
-from lxml.etree import Element, SubElement, tostring as ElementToString
+from lxml.etree import Element, SubElement, tostring as ElementToString, fromstring as ElementFromString
 
 import rpki.resource_set
 import rpki.up_down
@@ -76,6 +79,8 @@ class main(object):
 
         self.http_client_serialize = weakref.WeakValueDictionary()
 
+        self.object_locks = weakref.WeakValueDictionary()
+
         self.cfg = rpki.config.argparser(section = "rpkid", doc = __doc__)
         self.cfg.add_boolean_argument("--foreground", 
                                       default = False,
@@ -154,6 +159,13 @@ class main(object):
 
         self.cron_period = self.cfg.getint("cron-period", 1800)
 
+        self.rsa_keypair_pool = rsa_keypair_pool(
+            size      = self.cfg.getint("keypair-pool-size", 0),
+            processes = self.cfg.getint("keypair-pool-processes", 1))
+
+        self.crypto_pool = crypto_pool(
+            processes = self.cfg.getint("crypto-pool-processes", 0))
+
         if self.use_internal_cron:
             logger.debug("Scheduling initial cron pass in %s seconds", self.initial_delay)
             tornado.ioloop.IOLoop.current().spawn_callback(self.cron_loop)
@@ -189,6 +201,22 @@ class main(object):
 
         tornado.ioloop.IOLoop.current().start()
 
+    def object_lock(self, obj):
+        """
+        Return the lock serializing regeneration of one signed object
+        (a CADetail's CRL and manifest, or a ROA), so that coroutines
+        which yield to the crypto pool part way through can't both
+        replace the same old object.  Callers must keep a reference to
+        the lock while they hold it.
+        """
+
+        key = (obj.__class__.__name__, obj.pk)
+        try:
+            lock = self.object_locks[key]
+        except KeyError:
+            lock = self.object_locks[key] = tornado.locks.Lock()
+        return lock
+
     def task_add(self, *tasks):
         """
         Add tasks to the task queue.
@@ -329,7 +357,7 @@ class main(object):
 
         q_tags = set(q_pdu.tag for q_pdu in q_msg)
 
-        q_der = rpki.left_right.cms_msg().wrap(q_msg, self.rpkid_key, self.rpkid_cert)
+        q_der = yield self.crypto_pool.wrap(rpki.left_right.cms_msg(), q_msg, self.rpkid_key, self.rpkid_cert)
 
         http_request = tornado.httpclient.HTTPRequest(
             url             = self.irdb_url,
@@ -351,9 +379,10 @@ class main(object):
         r_der = http_response.body
 
         r_cms = rpki.left_right.cms_msg(DER = r_der)
-        r_msg = r_cms.unwrap((self.bpki_ta, self.irdb_cert))
 
-        self.irdbd_cms_timestamp = r_cms.check_replay(self.irdbd_cms_timestamp, self.irdb_url)
+        with (yield self.crypto_pool.replay_lock("irdb").acquire()):
+            r_msg, r_time = yield self.crypto_pool.unwrap(r_cms, (self.bpki_ta, self.irdb_cert))
+            self.irdbd_cms_timestamp = rpki.x509.check_replay_timestamp(r_time, self.irdbd_cms_timestamp, self.irdb_url)
 
         #rpki.left_right.check_response(r_msg)
 
@@ -537,10 +566,11 @@ class main(object):
 
         try:
             q_cms = rpki.left_right.cms_msg(DER = handler.request.body)
-            q_msg = q_cms.unwrap((self.bpki_ta, self.irbe_cert))
+            with (yield self.crypto_pool.replay_lock("irbe").acquire()):
+                q_msg, q_time = yield self.crypto_pool.unwrap(q_cms, (self.bpki_ta, self.irbe_cert))
+                self.irbe_cms_timestamp = rpki.x509.check_replay_timestamp(q_time, self.irbe_cms_timestamp, handler.request.path)
             r_msg = Element(rpki.left_right.tag_msg, nsmap = rpki.left_right.nsmap,
                             type = "reply", version = rpki.left_right.version)
-            self.irbe_cms_timestamp = q_cms.check_replay(self.irbe_cms_timestamp, handler.request.path)
 
             assert q_msg.tag.startswith(rpki.left_right.xmlns)
             assert all(q_pdu.tag.startswith(rpki.left_right.xmlns) for q_pdu in q_msg)
@@ -595,7 +625,8 @@ class main(object):
                     break
 
             handler.set_status(200)
-            handler.finish(rpki.left_right.cms_msg().wrap(r_msg, self.rpkid_key, self.rpkid_cert))
+            r_der = yield self.crypto_pool.wrap(rpki.left_right.cms_msg(), r_msg, self.rpkid_key, self.rpkid_cert)
+            handler.finish(r_der)
 
         except Exception, e:
             logger.exception("Unhandled exception serving left-right request")
@@ -793,3 +824,327 @@ class publication_queue(object):
 
     def empty(self):
         return not self.msgs
+
+
+def _generate_rsa_keypair(keylength):
+    """
+    Worker process side of rsa_keypair_pool: generate one keypair and
+    return it as DER, which is easier to ship between processes than a
+    POW object.
+    """
+
+    try:
+        return rpki.x509.RSA.generate(keylength = keylength, quiet = True).get_DER()
+    except:
+        logger.exception("Couldn't generate RSA keypair for pool")
+        return None
+
+
+class rsa_keypair_pool(object):
+    """
+    Pool of pre-generated RSA keypairs for one-shot EE certificates
+    (ROAs, Ghostbusters), kept topped up by worker processes so that key
+    generation doesn't stall the IOLoop during mass reissues.
+
+    Drawing from an empty pool falls back to generating a keypair
+    synchronously, as does a pool configured with size zero.
+    """
+
+    def __init__(self, size, keylength = 2048, processes = 1):
+        self.size = size
+        self.keylength = keylength
+        self.keys = collections.deque()
+        self.pending = 0
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.workers = multiprocessing.Pool(processes) if size > 0 else None
+        self.refill()
+
+    def refill(self):
+        """
+        Queue enough key generation requests to bring the pool up to size.
+        """
+
+        while self.workers is not None and len(self.keys) + self.pending < self.size:
+            self.pending += 1
+            self.workers.apply_async(_generate_rsa_keypair, (self.keylength,),
+                                     callback = self.callback)
+
+    def callback(self, der):
+        # Called in multiprocessing's result handler thread, so punt to
+        # the IOLoop before touching anything.
+        self.ioloop.add_callback(self.add, der)
+
+    def add(self, der):
+        self.pending -= 1
+        if der is not None:
+            self.keys.append(rpki.x509.RSA(DER = der))
+
+    def get(self):
+        """
+        Return a keypair from the pool, or a freshly generated one if
+        the pool is empty.
+        """
+
+        try:
+            keypair = self.keys.popleft()
+        except IndexError:
+            if self.workers is not None:
+                logger.debug("RSA keypair pool empty, generating keypair synchronously")
+            keypair = rpki.x509.RSA.generate(keylength = self.keylength)
+        self.refill()
+        return keypair
+
+
+def _crypto_pool_call(func, args):
+    """
+    Worker process side of crypto_pool: run one call and return a
+    (success, value) pair, since Python 2 multiprocessing has no error
+    callback and we don't want a failed call to strand its Future.
+    """
+
+    try:
+        return True, func(*args)
+    except Exception, e:
+        return False, e
+
+
+def _cms_unwrap(cls, der, ta):
+    """
+    Verify a CMS-wrapped XML message in a worker process, returning
+    the XML text of the inner content and the CMS signing time.
+    """
+
+    ta = tuple(rpki.x509.X509(DER = x) for x in ta)
+    cms = cls(DER = der)
+    msg = cms.unwrap(ta)
+    return ElementToString(msg), cms.get_signingTime()
+
+
+def _cms_wrap(cls, xml, keypair, certs, crls):
+    """
+    Sign an XML message in a worker process, returning the CMS DER.
+    """
+
+    return cls().wrap(ElementFromString(xml),
+                      rpki.x509.RSA(DER = keypair),
+                      tuple(rpki.x509.X509(DER = x) for x in certs),
+                      tuple(rpki.x509.CRL(DER = x) for x in crls))
+
+
+def _cert_issue(issuer, keypair, subject_key, serial, sia, aia, crldp, asn, v4, v6, notAfter):
+    """
+    Issue a CA certificate in a worker process, returning its DER.
+    Resources arrive in their text form.
+    """
+
+    return rpki.x509.X509(DER = issuer).issue(
+        keypair     = rpki.x509.RSA(DER = keypair),
+        subject_key = rpki.x509.PublicKey(DER = subject_key),
+        serial      = serial,
+        sia         = sia,
+        aia         = aia,
+        crldp       = crldp,
+        resources   = rpki.resource_set.resource_bag(asn = asn, v4 = v4, v6 = v6),
+        notAfter    = notAfter).get_DER()
+
+
+def _crl_generate(keypair, issuer, serial, thisUpdate, nextUpdate, revokedCertificates):
+    """
+    Generate and sign a CRL in a worker process, returning its DER.
+    """
+
+    return rpki.x509.CRL.generate(
+        keypair             = rpki.x509.RSA(DER = keypair),
+        issuer              = rpki.x509.X509(DER = issuer),
+        serial              = serial,
+        thisUpdate          = thisUpdate,
+        nextUpdate          = nextUpdate,
+        revokedCertificates = revokedCertificates).get_DER()
+
+
+def _manifest_build(serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs):
+    """
+    Build and sign a manifest in a worker process, returning its DER.
+    Objects to be listed arrive as (name, DER) pairs.
+    """
+
+    return rpki.x509.SignedManifest.build(
+        serial         = serial,
+        thisUpdate     = thisUpdate,
+        nextUpdate     = nextUpdate,
+        names_and_objs = [(name, rpki.x509.DER_object(DER = der)) for name, der in names_and_objs],
+        keypair        = rpki.x509.RSA(DER = keypair),
+        certs          = tuple(rpki.x509.X509(DER = x) for x in certs)).get_DER()
+
+
+def _roa_build(asn, ipv4, ipv6, keypair, certs):
+    """
+    Build and sign a ROA in a worker process, returning its DER.
+    Prefixes arrive in their text form.
+    """
+
+    return rpki.x509.ROA.build(asn,
+                               rpki.resource_set.roa_prefix_set_ipv4(ipv4),
+                               rpki.resource_set.roa_prefix_set_ipv6(ipv6),
+                               rpki.x509.RSA(DER = keypair),
+                               tuple(rpki.x509.X509(DER = x) for x in certs)).get_DER()
+
+
+class crypto_pool(object):
+    """
+    Pool of worker processes for CPU-heavy POW calls (CMS signing and
+    verification, certificate, CRL, manifest and ROA generation), so
+    that a burst of up-down or left-right traffic or a rekey doesn't
+    serialize behind the IOLoop.
+
+    A pool configured with zero processes runs everything inline, which
+    is also what we do if the pool isn't configured at all.
+    """
+
+    def __init__(self, processes = 0):
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.workers = multiprocessing.Pool(processes) if processes > 0 else None
+        self.replay_locks = collections.defaultdict(tornado.locks.Lock)
+
+    def replay_lock(self, *peer):
+        """
+        Return the lock serializing inbound messages from one peer.
+        Holding it from before unwrap() until the signing time has been
+        checked and recorded keeps messages which finish verification
+        out of order from failing each other's replay checks.
+        """
+
+        return self.replay_locks[peer]
+
+    def run(self, func, *args):
+        """
+        Run func(*args) in the pool, returning a Future.
+        """
+
+        future = tornado.concurrent.Future()
+        if self.workers is None:
+            try:
+                future.set_result(func(*args))
+            except Exception, e:
+                future.set_exception(e)
+        else:
+            self.workers.apply_async(_crypto_pool_call, (func, args),
+                                     callback = lambda result: self.ioloop.add_callback(self.done, future, result))
+        return future
+
+    @staticmethod
+    def done(future, result):
+        ok, value = result
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    @tornado.gen.coroutine
+    def unwrap(self, cms, ta):
+        """
+        Verify and unwrap a CMS-wrapped XML message, leaving the content
+        decoded in cms just as cms.unwrap() would.  Returns the content
+        and the CMS signing time, for the caller's replay check.
+        """
+
+        if self.workers is None:
+            msg = cms.unwrap(ta)
+            raise tornado.gen.Return((msg, cms.get_signingTime()))
+        ta = tuple(x.get_DER() for x in rpki.x509.X509.normalize_chain(ta))
+        xml, signing_time = yield self.run(_cms_unwrap, type(cms), cms.get_DER(), ta)
+        cms.decode(xml)
+        raise tornado.gen.Return((cms.get_content(), signing_time))
+
+    @tornado.gen.coroutine
+    def wrap(self, cms, msg, keypair, certs, crls = None):
+        """
+        Wrap an XML message in CMS and return its DER encoding.
+        """
+
+        if self.workers is None:
+            raise tornado.gen.Return(cms.wrap(msg, keypair, certs, crls))
+        if crls is None:
+            crls = ()
+        elif isinstance(crls, rpki.x509.CRL):
+            crls = (crls,)
+        der = yield self.run(_cms_wrap, type(cms), ElementToString(msg), keypair.get_DER(),
+                             tuple(x.get_DER() for x in rpki.x509.X509.normalize_chain(certs)),
+                             tuple(x.get_DER() for x in crls))
+        raise tornado.gen.Return(der)
+
+    @tornado.gen.coroutine
+    def issue_cert(self, issuer, keypair, subject_key, serial, sia, aia, crldp, resources, notAfter):
+        """
+        Issue a CA certificate, as issuer.issue() would.
+        """
+
+        if self.workers is None:
+            raise tornado.gen.Return(issuer.issue(
+                keypair     = keypair,
+                subject_key = subject_key,
+                serial      = serial,
+                sia         = sia,
+                aia         = aia,
+                crldp       = crldp,
+                resources   = resources,
+                notAfter    = notAfter))
+        der = yield self.run(_cert_issue, issuer.get_DER(), keypair.get_DER(), subject_key.get_DER(),
+                             serial, sia, aia, crldp,
+                             str(resources.asn), str(resources.v4), str(resources.v6), notAfter)
+        raise tornado.gen.Return(rpki.x509.X509(DER = der))
+
+    @tornado.gen.coroutine
+    def generate_crl(self, keypair, issuer, serial, thisUpdate, nextUpdate, revokedCertificates):
+        """
+        Generate and sign a CRL, as rpki.x509.CRL.generate() would.
+        """
+
+        if self.workers is None:
+            raise tornado.gen.Return(rpki.x509.CRL.generate(
+                keypair             = keypair,
+                issuer              = issuer,
+                serial              = serial,
+                thisUpdate          = thisUpdate,
+                nextUpdate          = nextUpdate,
+                revokedCertificates = revokedCertificates))
+        der = yield self.run(_crl_generate, keypair.get_DER(), issuer.get_DER(),
+                             serial, thisUpdate, nextUpdate, revokedCertificates)
+        raise tornado.gen.Return(rpki.x509.CRL(DER = der))
+
+    @tornado.gen.coroutine
+    def build_manifest(self, serial, thisUpdate, nextUpdate, names_and_objs, keypair, certs):
+        """
+        Build and sign a manifest, as rpki.x509.SignedManifest.build()
+        would.
+        """
+
+        if self.workers is None:
+            raise tornado.gen.Return(rpki.x509.SignedManifest.build(
+                serial         = serial,
+                thisUpdate     = thisUpdate,
+                nextUpdate     = nextUpdate,
+                names_and_objs = names_and_objs,
+                keypair        = keypair,
+                certs          = certs))
+        der = yield self.run(_manifest_build, serial, thisUpdate, nextUpdate,
+                             [(name, obj.get_DER()) for name, obj in names_and_objs],
+                             keypair.get_DER(),
+                             tuple(x.get_DER() for x in rpki.x509.X509.normalize_chain(certs)))
+        raise tornado.gen.Return(rpki.x509.SignedManifest(DER = der))
+
+    @tornado.gen.coroutine
+    def build_roa(self, asn, ipv4, ipv6, keypair, certs):
+        """
+        Build and sign a ROA, as rpki.x509.ROA.build() would, except
+        that ipv4 and ipv6 are the text forms of the prefix sets.
+        """
+
+        if self.workers is None:
+            raise tornado.gen.Return(rpki.x509.ROA.build(asn,
+                                                         rpki.resource_set.roa_prefix_set_ipv4(ipv4),
+                                                         rpki.resource_set.roa_prefix_set_ipv6(ipv6),
+                                                         keypair, certs))
+        der = yield self.run(_roa_build, asn, ipv4, ipv6, keypair.get_DER(),
+                             tuple(x.get_DER() for x in rpki.x509.X509.normalize_chain(certs)))
+        raise tornado.gen.Return(rpki.x509.ROA(DER = der))
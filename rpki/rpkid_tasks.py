@@ -239,7 +239,7 @@ class PollParentTask(AbstractTask):
                                "maybe parent certificate went away?",
                                ca_detail.public_key.gSKI(), class_name, parent.tenant.tenant_handle, parent.parent_handle)
                 publisher = rpki.rpkid.publication_queue(rpkid = self.rpkid)
-                ca_detail.destroy(publisher = publisher)
+                yield ca_detail.destroy(publisher = publisher)
                 yield publisher.call_pubd()
                 continue
 
@@ -311,7 +311,7 @@ class UpdateChildrenTask(AbstractTask):
                     logger.debug("Resources shrank to null set, revoking and withdrawing child %s g(SKI) %s",
                                  child_handle, child_cert.gski)
                     child_cert.revoke(publisher = publisher)
-                    ca_detail.generate_crl_and_manifest(publisher = publisher)
+                    yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
                 elif (old_resources != new_resources or old_aia != new_aia or
                       (old_resources.valid_until < rsn and
@@ -328,7 +328,7 @@ class UpdateChildrenTask(AbstractTask):
                                      irdb_resources[child_handle].valid_until)
 
                     new_resources.valid_until = irdb_resources[child_handle].valid_until
-                    child_cert.reissue(ca_detail = ca_detail, resources = new_resources, publisher = publisher)
+                    yield child_cert.reissue(ca_detail = ca_detail, resources = new_resources, publisher = publisher)
 
                 elif old_resources.valid_until < now:
                     logger.debug("Child %s certificate g(SKI) %s has expired: cert.valid_until %s, irdb.valid_until %s",
@@ -338,7 +338,7 @@ class UpdateChildrenTask(AbstractTask):
                     publisher.queue(uri = child_cert.uri,
                                     old_obj = child_cert.cert,
                                     repository = ca_detail.ca.parent.repository)
-                    ca_detail.generate_crl_and_manifest(publisher = publisher)
+                    yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
             except:
                 logger.exception("%r: Couldn't update %r, skipping", self, child_cert)
@@ -430,7 +430,7 @@ class UpdateROAsTask(AbstractTask):
                 break
             roa = roas.pop(0)
             try:
-                roa.update(publisher = publisher)
+                yield roa.update(publisher = publisher)
                 ca_details.add(roa.ca_detail.pk)
             except rpki.exceptions.NoCoveringCertForROA:
                 logger.warning("%r: No covering certificate for %r, skipping", self, roa)
@@ -441,14 +441,14 @@ class UpdateROAsTask(AbstractTask):
             for roa in orphans:
                 try:
                     ca_details.add(roa.ca_detail.pk)
-                    roa.revoke(publisher = publisher)
+                    yield roa.revoke(publisher = publisher)
                 except:
                     logger.exception("%r: Could not revoke %r", self, roa)
 
         if not publisher.empty():
             for ca_detail in rpki.rpkidb.models.CADetail.objects.filter(pk__in = ca_details):
                 logger.debug("%r: Generating new CRL and manifest for %r", self, ca_detail)
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                yield ca_detail.generate_crl_and_manifest(publisher = publisher)
             yield publisher.call_pubd()
 
         if postponing:
@@ -515,7 +515,7 @@ class UpdateGhostbustersTask(AbstractTask):
                 ghostbuster.revoke(publisher = publisher)
 
             for ca_detail in ca_details:
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
             yield publisher.call_pubd()
 
@@ -567,7 +567,7 @@ class UpdateEECertificatesTask(AbstractTask):
                 for ee in ees:
                     if ee.ca_detail in covering:
                         logger.debug("%r: Updating %r for %s %s", self, ee, gski, resources)
-                        ee.reissue(resources = resources, publisher = publisher)
+                        yield ee.reissue(resources = resources, publisher = publisher)
                         covering.remove(ee.ca_detail)
                     else:
                         # This probably never happens, as the most likely cause would be a CA certificate
@@ -609,7 +609,7 @@ class UpdateEECertificatesTask(AbstractTask):
                     ee.revoke(publisher = publisher)
 
             for ca_detail in ca_details:
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
             yield publisher.call_pubd()
 
@@ -643,13 +643,13 @@ class RegenerateCRLsAndManifestsTask(AbstractTask):
 
             for ca_detail in ca_details.filter(next_crl_manifest_update__lt = now,
                                                state = "revoked"):
-                ca_detail.destroy(publisher = publisher)
+                yield ca_detail.destroy(publisher = publisher)
 
             for ca_detail in ca_details.filter(state__in = ("active", "deprecated"),
                                                next_crl_manifest_update__lt = now + max(
                                                    rpki.sundial.timedelta(seconds = self.tenant.crl_interval) / 4,
                                                    rpki.sundial.timedelta(seconds = self.rpkid.cron_period  ) * 2)):
-                ca_detail.generate_crl_and_manifest(publisher = publisher)
+                yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
             yield publisher.call_pubd()
 
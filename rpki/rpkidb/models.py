@@ -19,6 +19,7 @@ Django ORM models for rpkid.
 
 from __future__ import unicode_literals
 
+import bisect
 import logging
 
 import tornado.gen
@@ -29,6 +30,8 @@ import tornado.httpclient
 import tornado.httpserver
 
 from django.db import models
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
 
 import rpki.left_right
 import rpki.sundial
@@ -272,6 +275,90 @@ def xml_hooks(cls):
     return cls
 
 
+class CoveringIndex(object):
+    """
+    Index from resources to the active CADetails of one <tenant/> whose
+    certificates cover them, so that we don't have to parse every CA
+    certificate each time we look for a covering certificate.
+
+    Each address family is split into elementary intervals at every
+    range boundary of every certificate, with the set of CADetails
+    covering each interval, so a lookup is a bisection per range.
+
+    Instances are cached per <tenant/> in covering_indexes and thrown
+    away by the CADetail signal handlers below whenever an active
+    CADetail changes state or certificate.
+    """
+
+    def __init__(self, ca_details):
+        self.certs = {}
+        self.not_after = {}
+        sets = dict(asn = [], v4 = [], v6 = [])
+        for ca_detail in ca_details:
+            self.certs[ca_detail.pk] = ca_detail.latest_ca_cert.get_DER()
+            self.not_after[ca_detail.pk] = ca_detail.latest_ca_cert.getNotAfter()
+            resources = ca_detail.latest_ca_cert.get_3779resources()
+            for name in sets:
+                sets[name].append((ca_detail.pk, getattr(resources, name)))
+        self.asn = self._build(sets["asn"])
+        self.v4  = self._build(sets["v4"])
+        self.v6  = self._build(sets["v6"])
+
+    @staticmethod
+    def _build(sets):
+        events = {}
+        for pk, rset in sets:
+            if rset.inherit:
+                continue
+            for r in rset:
+                events.setdefault(long(r.min),     []).append((pk, +1))
+                events.setdefault(long(r.max) + 1, []).append((pk, -1))
+        bounds = sorted(events)
+        segments = []
+        current = {}
+        for b in bounds:
+            for pk, delta in events[b]:
+                current[pk] = current.get(pk, 0) + delta
+            segments.append(frozenset(pk for pk, n in current.iteritems() if n > 0))
+        return bounds, segments
+
+    @staticmethod
+    def _lookup(index, rset, candidates):
+        bounds, segments = index
+        for r in rset:
+            lo, hi = long(r.min), long(r.max)
+            i = bisect.bisect_right(bounds, lo) - 1
+            if i < 0:
+                return set()
+            while i < len(bounds) and bounds[i] <= hi and candidates:
+                candidates &= segments[i]
+                i += 1
+            if not candidates:
+                break
+        return candidates
+
+    def covering(self, target):
+        """
+        Return primary keys of the CADetails which cover target.
+        """
+
+        assert not target.asn.inherit and not target.v4.inherit and not target.v6.inherit
+        candidates = set(self.certs)
+        for name in ("asn", "v4", "v6"):
+            candidates = self._lookup(getattr(self, name), getattr(target, name), candidates)
+        return candidates
+
+    def unexpired(self, pks):
+        """
+        Filter out primary keys of CADetails whose certificates have expired.
+        """
+
+        now = rpki.sundial.now()
+        return set(pk for pk in pks if self.not_after[pk] > now)
+
+covering_indexes = {}
+
+
 # Models.
 #
 # There's far too much random code hanging off of model methods, relic
@@ -406,22 +493,31 @@ class Tenant(models.Model):
             return self._cron_tasks
 
 
+    def covering_index(self):
+        """
+        Return the CoveringIndex for this <tenant/>, building it if
+        we don't already have one cached.
+        """
+
+        try:
+            return covering_indexes[self.pk]
+        except KeyError:
+            index = CoveringIndex(CADetail.objects.filter(ca__parent__tenant = self, state = "active"))
+            covering_indexes[self.pk] = index
+            return index
+
+
     def find_covering_ca_details(self, resources):
         """
         Return all active CADetails for this <tenant/> which cover a
         particular set of resources.
-
-        If we expected there to be a large number of CADetails, we
-        could add index tables and write fancy SQL query to do this, but
-        for the expected common case where there are only one or two
-        active CADetails per <tenant/>, it's probably not worth it.  In
-        any case, this is an optimization we can leave for later.
         """
 
         trace_call_chain()
-        return set(ca_detail
-                   for ca_detail in CADetail.objects.filter(ca__parent__tenant = self, state = "active")
-                   if ca_detail.covers(resources))
+        pks = self.covering_index().covering(resources)
+        if not pks:
+            return set()
+        return set(CADetail.objects.filter(pk__in = pks))
 
 
 @xml_hooks
@@ -525,11 +621,12 @@ class Repository(models.Model):
             handlers = {}
         for q_pdu in q_msg:
             logger.info("Sending %r hash = %s uri = %s to pubd", q_pdu, q_pdu.get("hash"), q_pdu.get("uri"))
+        q_der = yield rpkid.crypto_pool.wrap(rpki.publication.cms_msg(), q_msg, self.bsc.private_key_id,
+                                             self.bsc.signing_cert, self.bsc.signing_cert_crl)
         http_request = tornado.httpclient.HTTPRequest(
             url             = self.peer_contact_uri,
             method          = "POST",
-            body            = rpki.publication.cms_msg().wrap(q_msg, self.bsc.private_key_id,
-                                                              self.bsc.signing_cert, self.bsc.signing_cert_crl),
+            body            = q_der,
             headers         = { "Content-Type" : rpki.publication.content_type },
             connect_timeout = rpkid.http_client_timeout,
             request_timeout = rpkid.http_client_timeout)
@@ -538,8 +635,10 @@ class Repository(models.Model):
             raise rpki.exceptions.BadContentType("HTTP Content-Type %r, expected %r" % (
                 rpki.publication.content_type, http_response.headers.get("Content-Type")))
         r_cms = rpki.publication.cms_msg(DER = http_response.body)
-        r_msg = r_cms.unwrap((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
-        r_cms.check_replay_sql(self, self.peer_contact_uri)
+        with (yield rpkid.crypto_pool.replay_lock("repository", self.pk).acquire()):
+            r_msg, r_time = yield rpkid.crypto_pool.unwrap(r_cms, (rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue,
+                                                                   self.bpki_cert, self.bpki_glue))
+            rpki.x509.check_replay_timestamp_sql(r_time, self, self.peer_contact_uri)
         for r_pdu in r_msg:
             logger.info("Received %r hash = %s uri = %s from pubd", r_pdu, r_pdu.get("hash"), r_pdu.get("uri"))
             handler = handlers.get(r_pdu.get("uri"), rpki.publication.raise_if_error)
@@ -771,12 +870,12 @@ class Parent(models.Model):
         elif self.bsc.signing_cert is None:
             raise rpki.exceptions.BSCNotReady("%r is not yet usable" % self.bsc)
         else:
+            q_der = yield rpkid.crypto_pool.wrap(rpki.up_down.cms_msg(), q_msg, self.bsc.private_key_id,
+                                                 self.bsc.signing_cert, self.bsc.signing_cert_crl)
             http_request = tornado.httpclient.HTTPRequest(
                 url             = self.peer_contact_uri,
                 method          = "POST",
-                body            = rpki.up_down.cms_msg().wrap(q_msg, self.bsc.private_key_id,
-                                                              self.bsc.signing_cert,
-                                                              self.bsc.signing_cert_crl),
+                body            = q_der,
                 headers         = { "Content-Type" : rpki.up_down.content_type },
                 connect_timeout = rpkid.http_client_timeout,
                 request_timeout = rpkid.http_client_timeout)
@@ -785,10 +884,11 @@ class Parent(models.Model):
                 raise rpki.exceptions.BadContentType("HTTP Content-Type %r, expected %r" % (
                     rpki.up_down.content_type, http_response.headers.get("Content-Type")))
             r_cms = rpki.up_down.cms_msg(DER = http_response.body)
-            r_msg = r_cms.unwrap((rpkid.bpki_ta,
-                                  self.tenant.bpki_cert, self.tenant.bpki_glue,
-                                  self.bpki_cert, self.bpki_glue))
-            r_cms.check_replay_sql(self, self.peer_contact_uri)
+            with (yield rpkid.crypto_pool.replay_lock("parent", self.pk).acquire()):
+                r_msg, r_time = yield rpkid.crypto_pool.unwrap(r_cms, (rpkid.bpki_ta,
+                                                                       self.tenant.bpki_cert, self.tenant.bpki_glue,
+                                                                       self.bpki_cert, self.bpki_glue))
+                rpki.x509.check_replay_timestamp_sql(r_time, self, self.peer_contact_uri)
         #logger.debug("%r query_up_down(): %s", self, ElementToString(r_msg))
         rpki.up_down.check_response(r_msg, q_msg.get("type"))
         raise tornado.gen.Return(r_msg)
@@ -992,7 +1092,7 @@ class CA(models.Model):
         trace_call_chain()
         publisher = rpki.rpkid.publication_queue(rpkid = rpkid)
         for ca_detail in self.ca_details.all():
-            ca_detail.destroy(publisher = publisher, allow_failure = True)
+            yield ca_detail.destroy(publisher = publisher, allow_failure = True)
         try:
             yield publisher.call_pubd()
         except:
@@ -1113,7 +1213,7 @@ class CA(models.Model):
                 child_cert.revoke(publisher = publisher)
             for roa in ca_detail.roas.all():
                 nextUpdate = nextUpdate.later(roa.cert.getNotAfter())
-                roa.revoke(publisher = publisher)
+                yield roa.revoke(publisher = publisher)
             for ghostbuster in ca_detail.ghostbusters.all():
                 nextUpdate = nextUpdate.later(ghostbuster.cert.getNotAfter())
                 ghostbuster.revoke(publisher = publisher)
@@ -1122,7 +1222,7 @@ class CA(models.Model):
                 eecert.revoke(publisher = publisher)
             nextUpdate += rpki.sundial.timedelta(seconds = self.parent.tenant.crl_interval)
 
-            ca_detail.generate_crl_and_manifest(publisher = publisher, nextUpdate = nextUpdate)
+            yield ca_detail.generate_crl_and_manifest(publisher = publisher, nextUpdate = nextUpdate)
             ca_detail.private_key_id = None
             ca_detail.manifest_private_key_id = None
             ca_detail.manifest_public_key = None
@@ -1228,25 +1328,26 @@ class CADetail(models.Model):
         self.latest_ca_cert = cert
         self.ca_cert_uri = uri
         self.state = "active"
-        self.generate_crl_and_manifest(publisher = publisher)
+        yield self.generate_crl_and_manifest(publisher = publisher)
         self.save()
 
         if predecessor is not None:
             predecessor.state = "deprecated"
             predecessor.save()
             for child_cert in predecessor.child_certs.all():
-                child_cert.reissue(ca_detail = self, publisher = publisher)
+                yield child_cert.reissue(ca_detail = self, publisher = publisher)
             for roa in predecessor.roas.all():
-                roa.regenerate(publisher = publisher)
+                yield roa.regenerate(publisher = publisher)
             for ghostbuster in predecessor.ghostbusters.all():
                 ghostbuster.regenerate(publisher = publisher)
             for eecert in predecessor.ee_certificates.all():
-                eecert.reissue(publisher = publisher, ca_detail = self)
-            predecessor.generate_crl_and_manifest(publisher = publisher)
+                yield eecert.reissue(publisher = publisher, ca_detail = self)
+            yield predecessor.generate_crl_and_manifest(publisher = publisher)
 
         yield publisher.call_pubd()
 
 
+    @tornado.gen.coroutine
     def destroy(self, publisher, allow_failure = False):
         """
         Delete this ca_detail and all of the certs it issued.
@@ -1262,7 +1363,7 @@ class CADetail(models.Model):
             publisher.queue(uri = child_cert.uri, old_obj = child_cert.cert, repository = repository, handler = handler)
             child_cert.delete()
         for roa in self.roas.all():
-            roa.revoke(publisher = publisher, allow_failure = allow_failure)
+            yield roa.revoke(publisher = publisher, allow_failure = allow_failure)
         for ghostbuster in self.ghostbusters.all():
             ghostbuster.revoke(publisher = publisher, allow_failure = allow_failure)
         for eecert in self.ee_certificates.all():
@@ -1309,7 +1410,7 @@ class CADetail(models.Model):
         if self.latest_ca_cert != cert:
             self.latest_ca_cert = cert
             self.save()
-            self.generate_crl_and_manifest(publisher = publisher)
+            yield self.generate_crl_and_manifest(publisher = publisher)
 
         new_resources = self.latest_ca_cert.get_3779resources()
 
@@ -1317,11 +1418,11 @@ class CADetail(models.Model):
             for child_cert in self.child_certs.all():
                 child_resources = child_cert.cert.get_3779resources()
                 if sia_uri_changed or child_resources.oversized(new_resources):
-                    child_cert.reissue(ca_detail = self, resources = child_resources & new_resources, publisher = publisher)
+                    yield child_cert.reissue(ca_detail = self, resources = child_resources & new_resources, publisher = publisher)
 
         if sia_uri_changed or validity_changed or old_resources.oversized(new_resources):
             for roa in self.roas.all():
-                roa.update(publisher = publisher)
+                yield roa.update(publisher = publisher)
 
         if sia_uri_changed or validity_changed:
             for ghostbuster in self.ghostbusters.all():
@@ -1355,6 +1456,7 @@ class CADetail(models.Model):
             eku         = eku)
 
 
+    @tornado.gen.coroutine
     def issue(self, ca, child, subject_key, sia, resources, publisher, child_cert = None):
         """
         Issue a new certificate to a child.  Optional child_cert argument
@@ -1365,7 +1467,8 @@ class CADetail(models.Model):
 
         trace_call_chain()
         self.check_failed_publication(publisher)
-        cert = self.latest_ca_cert.issue(
+        cert = yield publisher.rpkid.crypto_pool.issue_cert(
+            issuer      = self.latest_ca_cert,
             keypair     = self.private_key_id,
             subject_key = subject_key,
             serial      = ca.next_serial_number(),
@@ -1392,10 +1495,11 @@ class CADetail(models.Model):
             new_obj    = child_cert.cert,
             repository = ca.parent.repository,
             handler    = child_cert.published_callback)
-        self.generate_crl_and_manifest(publisher = publisher)
-        return child_cert
+        yield self.generate_crl_and_manifest(publisher = publisher)
+        raise tornado.gen.Return(child_cert)
 
 
+    @tornado.gen.coroutine
     def generate_crl_and_manifest(self, publisher, nextUpdate = None):
         """
         Generate a new CRL and a new manifest for this ca_detail.
@@ -1409,81 +1513,90 @@ class CADetail(models.Model):
 
         trace_call_chain()
 
-        self.check_failed_publication(publisher)
+        # Everything from reading the old CRL and manifest to queuing
+        # their replacements happens under the lock, so that concurrent
+        # calls for this ca_detail can't both replace the same objects.
 
-        crl_interval = rpki.sundial.timedelta(seconds = self.ca.parent.tenant.crl_interval)
-        now = rpki.sundial.now()
-        if nextUpdate is None:
-            nextUpdate = now + crl_interval
-
-        old_crl      = self.latest_crl
-        old_manifest = self.latest_manifest
-        crl_uri      = self.crl_uri
-        manifest_uri = self.manifest_uri
-
-        crl_manifest_number = self.ca.next_crl_manifest_number()
-
-        manifest_cert = self.issue_ee(
-            ca          = self.ca,
-            resources   = rpki.resource_set.resource_bag.from_inheritance(),
-            subject_key = self.manifest_public_key,
-            sia         = (None, None, manifest_uri, self.ca.parent.repository.rrdp_notification_uri),
-            notBefore   = now)
-
-        certlist = []
-        for revoked_cert in self.revoked_certs.all():
-            if now > revoked_cert.expires + crl_interval:
-                revoked_cert.delete()
-            else:
-                certlist.append((revoked_cert.serial, revoked_cert.revoked))
-        certlist.sort()
-
-        self.latest_crl = rpki.x509.CRL.generate(
-            keypair             = self.private_key_id,
-            issuer              = self.latest_ca_cert,
-            serial              = crl_manifest_number,
-            thisUpdate          = now,
-            nextUpdate          = nextUpdate,
-            revokedCertificates = certlist)
-
-        # XXX
-        logger.debug("%r Generating manifest, child_certs_all(): %r", self, self.child_certs.all())
-
-        objs = [(self.crl_uri_tail, self.latest_crl)]
-        objs.extend((c.uri_tail, c.cert)        for c in self.child_certs.all())
-        objs.extend((r.uri_tail, r.roa)         for r in self.roas.filter(roa__isnull = False))
-        objs.extend((g.uri_tail, g.ghostbuster) for g in self.ghostbusters.all())
-        objs.extend((e.uri_tail, e.cert)        for e in self.ee_certificates.all())
-
-        # XXX
-        logger.debug("%r Generating manifest, objs: %r", self, objs)
-
-        self.latest_manifest = rpki.x509.SignedManifest.build(
-            serial         = crl_manifest_number,
-            thisUpdate     = now,
-            nextUpdate     = nextUpdate,
-            names_and_objs = objs,
-            keypair        = self.manifest_private_key_id,
-            certs          = manifest_cert)
-
-        self.crl_published      = now
-        self.manifest_published = now
-        self.next_crl_manifest_update = nextUpdate
-        self.save()
+        lock = publisher.rpkid.object_lock(self)
 
-        publisher.queue(
-            uri        = crl_uri,
-            old_obj    = old_crl,
-            new_obj    = self.latest_crl,
-            repository = self.ca.parent.repository,
-            handler    = self.crl_published_callback)
+        with (yield lock.acquire()):
 
-        publisher.queue(
-            uri        = manifest_uri,
-            old_obj    = old_manifest,
-            new_obj    = self.latest_manifest,
-            repository = self.ca.parent.repository,
-            handler    = self.manifest_published_callback)
+            self.refresh_from_db(fields = ("latest_crl", "latest_manifest"))
+            self.check_failed_publication(publisher)
+
+            crl_interval = rpki.sundial.timedelta(seconds = self.ca.parent.tenant.crl_interval)
+            now = rpki.sundial.now()
+            if nextUpdate is None:
+                nextUpdate = now + crl_interval
+
+            old_crl      = self.latest_crl
+            old_manifest = self.latest_manifest
+            crl_uri      = self.crl_uri
+            manifest_uri = self.manifest_uri
+
+            crl_manifest_number = self.ca.next_crl_manifest_number()
+
+            manifest_cert = self.issue_ee(
+                ca          = self.ca,
+                resources   = rpki.resource_set.resource_bag.from_inheritance(),
+                subject_key = self.manifest_public_key,
+                sia         = (None, None, manifest_uri, self.ca.parent.repository.rrdp_notification_uri),
+                notBefore   = now)
+
+            certlist = []
+            for revoked_cert in self.revoked_certs.all():
+                if now > revoked_cert.expires + crl_interval:
+                    revoked_cert.delete()
+                else:
+                    certlist.append((revoked_cert.serial, revoked_cert.revoked))
+            certlist.sort()
+
+            self.latest_crl = yield publisher.rpkid.crypto_pool.generate_crl(
+                keypair             = self.private_key_id,
+                issuer              = self.latest_ca_cert,
+                serial              = crl_manifest_number,
+                thisUpdate          = now,
+                nextUpdate          = nextUpdate,
+                revokedCertificates = certlist)
+
+            # XXX
+            logger.debug("%r Generating manifest, child_certs_all(): %r", self, self.child_certs.all())
+
+            objs = [(self.crl_uri_tail, self.latest_crl)]
+            objs.extend((c.uri_tail, c.cert)        for c in self.child_certs.all())
+            objs.extend((r.uri_tail, r.roa)         for r in self.roas.filter(roa__isnull = False))
+            objs.extend((g.uri_tail, g.ghostbuster) for g in self.ghostbusters.all())
+            objs.extend((e.uri_tail, e.cert)        for e in self.ee_certificates.all())
+
+            # XXX
+            logger.debug("%r Generating manifest, objs: %r", self, objs)
+
+            self.latest_manifest = yield publisher.rpkid.crypto_pool.build_manifest(
+                serial         = crl_manifest_number,
+                thisUpdate     = now,
+                nextUpdate     = nextUpdate,
+                names_and_objs = objs,
+                keypair        = self.manifest_private_key_id,
+                certs          = manifest_cert)
+
+            self.crl_published      = now
+            self.manifest_published = now
+            self.next_crl_manifest_update = nextUpdate
+            self.save()
+
+            publisher.queue(
+                uri        = crl_uri,
+                old_obj    = old_crl,
+                new_obj    = self.latest_crl,
+                repository = self.ca.parent.repository,
+                handler    = self.crl_published_callback)
+
+            publisher.queue(
+                uri        = manifest_uri,
+                old_obj    = old_manifest,
+                new_obj    = self.latest_manifest,
+                repository = self.ca.parent.repository,
+                handler    = self.manifest_published_callback)
 
 
     def crl_published_callback(self, pdu):
@@ -1517,14 +1630,14 @@ class CADetail(models.Model):
         publisher = rpki.rpkid.publication_queue(rpkid = rpkid)
         self.check_failed_publication(publisher)
         for roa in self.roas.all():
-            roa.regenerate(publisher)
+            yield roa.regenerate(publisher)
         for ghostbuster in self.ghostbusters.all():
             ghostbuster.regenerate(publisher)
         for ee_certificate in self.ee_certificates.all():
-            ee_certificate.reissue(publisher, force = True)
+            yield ee_certificate.reissue(publisher, force = True)
         for child_cert in self.child_certs.all():
-            child_cert.reissue(self, publisher, force = True)
-        self.generate_crl_and_manifest(publisher = publisher)
+            yield child_cert.reissue(self, publisher, force = True)
+        yield self.generate_crl_and_manifest(publisher = publisher)
         self.save()
         yield publisher.call_pubd()
 
@@ -1604,6 +1717,38 @@ class CADetail(models.Model):
                 handler    = ee_cert.published_callback)
 
 
+@receiver(post_save, sender = CADetail)
+def _covering_index_post_save(sender, instance, **kwargs):
+    """
+    Discard the covering index for this CADetail's <tenant/> if the
+    CADetail just became active, stopped being active, or changed
+    certificate.  Saves which leave those alone (eg, new CRL and
+    manifest) keep the index.
+    """
+
+    if not covering_indexes:
+        return
+    indexed = any(instance.pk in index.certs for index in covering_indexes.itervalues())
+    if instance.state != "active" and not indexed:
+        return
+    if instance.state == "active" and indexed and any(
+            index.certs.get(instance.pk) == instance.latest_ca_cert.get_DER()
+            for index in covering_indexes.itervalues()):
+        return
+    covering_indexes.pop(instance.ca.parent.tenant_id, None)
+
+
+@receiver(post_delete, sender = CADetail)
+def _covering_index_post_delete(sender, instance, **kwargs):
+    """
+    Discard any covering index which includes a deleted CADetail.
+    """
+
+    for tenant_id, index in covering_indexes.items():
+        if instance.pk in index.certs:
+            del covering_indexes[tenant_id]
+
+
 @xml_hooks
 class Child(models.Model):
     child_handle = models.SlugField(max_length = 255)
@@ -1638,7 +1783,7 @@ class Child(models.Model):
             ca_details.add(child_cert.ca_detail)
             child_cert.revoke(publisher = publisher)
         for ca_detail in ca_details:
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
+            yield ca_detail.generate_crl_and_manifest(publisher = publisher)
         yield publisher.call_pubd()
 
 
@@ -1651,11 +1796,12 @@ class Child(models.Model):
             yield self.serve_reissue(rpkid = rpkid)
 
 
+    @tornado.gen.coroutine
     def serve_reissue(self, rpkid):
         trace_call_chain()
         publisher = rpki.rpkid.publication_queue(rpkid = rpkid)
         for child_cert in self.child_certs.all():
-            child_cert.reissue(child_cert.ca_detail, publisher, force = True)
+            yield child_cert.reissue(child_cert.ca_detail, publisher, force = True)
         yield publisher.call_pubd()
 
 
@@ -1734,7 +1880,7 @@ class Child(models.Model):
             child_cert = self.child_certs.get(ca_detail = ca_detail, gski = req_key.gSKI())
 
         except ChildCert.DoesNotExist:
-            child_cert = ca_detail.issue(
+            child_cert = yield ca_detail.issue(
                 ca          = ca_detail.ca,
                 child       = self,
                 subject_key = req_key,
@@ -1743,7 +1889,7 @@ class Child(models.Model):
                 publisher   = publisher)
 
         else:
-            child_cert = child_cert.reissue(
+            child_cert = yield child_cert.reissue(
                 ca_detail = ca_detail,
                 sia       = req_sia,
                 resources = resources,
@@ -1777,7 +1923,7 @@ class Child(models.Model):
             ca_details.add(child_cert.ca_detail)
             child_cert.revoke(publisher = publisher)
         for ca_detail in ca_details:
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
+            yield ca_detail.generate_crl_and_manifest(publisher = publisher)
         yield publisher.call_pubd()
         SubElement(r_msg, key.tag, class_name = class_name, ski = key.get("ski"))
 
@@ -1794,8 +1940,10 @@ class Child(models.Model):
             raise rpki.exceptions.BSCNotFound("Could not find BSC")
 
         q_cms = rpki.up_down.cms_msg(DER = q_der)
-        q_msg = q_cms.unwrap((rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue, self.bpki_cert, self.bpki_glue))
-        q_cms.check_replay_sql(self, "child", self.child_handle)
+        with (yield rpkid.crypto_pool.replay_lock("child", self.pk).acquire()):
+            q_msg, q_time = yield rpkid.crypto_pool.unwrap(q_cms, (rpkid.bpki_ta, self.tenant.bpki_cert, self.tenant.bpki_glue,
+                                                                   self.bpki_cert, self.bpki_glue))
+            rpki.x509.check_replay_timestamp_sql(q_time, self, "child", self.child_handle)
         q_type = q_msg.get("type")
 
         logger.info("Serving %s query from child %s [sender %s, recipient %s]",
@@ -1814,7 +1962,8 @@ class Child(models.Model):
             logger.exception("Unhandled exception serving child %r", self)
             rpki.up_down.generate_error_response_from_exception(r_msg, e, q_type)
 
-        r_der = rpki.up_down.cms_msg().wrap(r_msg, self.bsc.private_key_id, self.bsc.signing_cert, self.bsc.signing_cert_crl)
+        r_der = yield rpkid.crypto_pool.wrap(rpki.up_down.cms_msg(), r_msg, self.bsc.private_key_id,
+                                             self.bsc.signing_cert, self.bsc.signing_cert_crl)
         raise tornado.gen.Return(r_der)
 
 class ChildCert(models.Model):
@@ -1864,6 +2013,7 @@ class ChildCert(models.Model):
         self.delete()
 
 
+    @tornado.gen.coroutine
     def reissue(self, ca_detail, publisher, resources = None, sia = None, force = False):
         """
         Reissue an existing child cert, reusing the public key.  If
@@ -1916,13 +2066,13 @@ class ChildCert(models.Model):
             needed = True
         if not needed:
             logger.debug("No change to %r", self)
-            return self
+            raise tornado.gen.Return(self)
         if must_revoke:
             for child_cert in child.child_certs.filter(ca_detail = ca_detail, gski = self.gski):
                 logger.debug("Revoking %r", child_cert)
                 child_cert.revoke(publisher = publisher)
-            ca_detail.generate_crl_and_manifest(publisher = publisher)
-        child_cert = ca_detail.issue(
+            yield ca_detail.generate_crl_and_manifest(publisher = publisher)
+        child_cert = yield ca_detail.issue(
             ca          = ca,
             child       = child,
             subject_key = self.cert.getPublicKey(),
@@ -1931,7 +2081,7 @@ class ChildCert(models.Model):
             child_cert  = None if must_revoke else self,
             publisher   = publisher)
         logger.debug("New %r", child_cert)
-        return child_cert
+        raise tornado.gen.Return(child_cert)
 
 
     def published_callback(self, pdu):
@@ -1992,6 +2142,7 @@ class EECertificate(models.Model):
         self.delete()
 
 
+    @tornado.gen.coroutine
     def reissue(self, publisher, ca_detail = None, resources = None, force = False):
         """
         Reissue an existing EE cert, reusing the public key.  If the EE
@@ -2054,7 +2205,7 @@ class EECertificate(models.Model):
             handler    = self.published_callback)
         if must_revoke:
             RevokedCert.revoke(cert = old_cert.cert, ca_detail = old_ca_detail)
-        ca_detail.generate_crl_and_manifest(publisher = publisher)
+        yield ca_detail.generate_crl_and_manifest(publisher = publisher)
 
 
     def published_callback(self, pdu):
@@ -2123,7 +2274,7 @@ class Ghostbuster(models.Model):
 
         trace_call_chain()
         resources = rpki.resource_set.resource_bag.from_inheritance()
-        keypair = rpki.x509.RSA.generate()
+        keypair = publisher.rpkid.rsa_keypair_pool.get()
         self.cert = self.ca_detail.issue_ee(
             ca          = self.ca_detail.ca,
             resources   = resources,
@@ -2282,6 +2433,7 @@ class ROA(models.Model):
             return "<ROA: ROA object>"
 
 
+    @tornado.gen.coroutine
     def update(self, publisher):
         """
         Bring ROA up to date if necesssary.
@@ -2291,22 +2443,26 @@ class ROA(models.Model):
 
         if self.roa is None:
             logger.debug("%r doesn't exist, generating", self)
-            return self.generate(publisher = publisher)
+            yield self.generate(publisher = publisher)
+            return
 
         if self.ca_detail is None:
             logger.debug("%r has no associated ca_detail, generating", self)
-            return self.generate(publisher = publisher)
+            yield self.generate(publisher = publisher)
+            return
 
         if self.ca_detail.state != "active":
             logger.debug("ca_detail associated with %r not active (state %s), regenerating", self, self.ca_detail.state)
-            return self.regenerate(publisher = publisher)
+            yield self.regenerate(publisher = publisher)
+            return
 
         now = rpki.sundial.now()
         regen_time = self.cert.getNotAfter() - rpki.sundial.timedelta(seconds = self.tenant.regen_margin)
 
         if now > regen_time and self.cert.getNotAfter() < self.ca_detail.latest_ca_cert.getNotAfter():
             logger.debug("%r past threshold %s, regenerating", self, regen_time)
-            return self.regenerate(publisher = publisher)
+            yield self.regenerate(publisher = publisher)
+            return
 
         if now > regen_time:
             logger.warning("%r is past threshold %s but so is issuer %r, can't regenerate", self, regen_time, self.ca_detail)
@@ -2316,39 +2472,52 @@ class ROA(models.Model):
 
         if ee_resources.oversized(ca_resources):
             logger.debug("%r oversized with respect to CA, regenerating", self)
-            return self.regenerate(publisher = publisher)
+            yield self.regenerate(publisher = publisher)
+            return
 
         v4 = rpki.resource_set.resource_set_ipv4(self.ipv4)
         v6 = rpki.resource_set.resource_set_ipv6(self.ipv6)
 
         if ee_resources.v4 != v4 or ee_resources.v6 != v6:
             logger.debug("%r resources do not match EE, regenerating", self)
-            return self.regenerate(publisher = publisher)
+            yield self.regenerate(publisher = publisher)
+            return
 
         if self.cert.get_AIA()[0] != self.ca_detail.ca_cert_uri:
             logger.debug("%r AIA changed, regenerating", self)
-            return self.regenerate(publisher = publisher)
+            yield self.regenerate(publisher = publisher)
+            return
 
 
+    @tornado.gen.coroutine
     def generate(self, publisher):
         """
         Generate a ROA.
 
-        At present we have no way of performing a direct lookup from a
-        desired set of resources to a covering certificate, so we have to
-        search.  This could be quite slow if we have a lot of active
-        ca_detail objects.  Punt on the issue for now, revisit if
-        profiling shows this as a hotspot.
+        We find the covering certificate via the <tenant/>'s
+        CoveringIndex, preferring the oldest unexpired CADetail if more
+        than one covers the ROA's prefixes.
 
         Once we have the right covering certificate, we generate the ROA
         payload, generate a new EE certificate, use the EE certificate to
         sign the ROA payload, publish the result, then throw away the
         private key for the EE cert, all per the ROA specification.  This
         implies that generating a lot of ROAs will tend to thrash
-        /dev/random, but there is not much we can do about that.
+        /dev/random, so we draw keypairs from rpkid's pre-generated pool
+        rather than generating them here.
         """
 
         trace_call_chain()
+        lock = publisher.rpkid.object_lock(self)
+        with (yield lock.acquire()):
+            yield self._generate(publisher)
+
+
+    @tornado.gen.coroutine
+    def _generate(self, publisher):
+        """
+        Body of .generate(), for callers already holding this ROA's lock.
+        """
 
         if self.ipv4 is None and self.ipv6 is None:
             raise rpki.exceptions.EmptyROAPrefixList
@@ -2367,17 +2536,15 @@ class ROA(models.Model):
             logger.debug("Keeping old ca_detail %r for ROA %r", ca_detail, self)
         else:
             logger.debug("Searching for new ca_detail for ROA %r", self)
-            for ca_detail in CADetail.objects.filter(ca__parent__tenant = self.tenant, state = "active"):
-                resources = ca_detail.latest_ca_cert.get_3779resources()
-                if not ca_detail.has_expired() and v4.issubset(resources.v4) and v6.issubset(resources.v6):
-                    logger.debug("Using %r for ROA %r", ca_detail, self)
-                    self.ca_detail = ca_detail
-                    break
-            else:
+            index = self.tenant.covering_index()
+            pks = index.unexpired(index.covering(rpki.resource_set.resource_bag(v4 = v4, v6 = v6)))
+            if not pks:
                 raise rpki.exceptions.NoCoveringCertForROA("Could not find a certificate covering %r" % self)
+            self.ca_detail = CADetail.objects.get(pk = min(pks))
+            logger.debug("Using %r for ROA %r", self.ca_detail, self)
 
         resources = rpki.resource_set.resource_bag(v4 = v4, v6 = v6)
-        keypair = rpki.x509.RSA.generate()
+        keypair = publisher.rpkid.rsa_keypair_pool.get()
 
         self.cert = self.ca_detail.issue_ee(
             ca          = self.ca_detail.ca,
@@ -2385,11 +2552,11 @@ class ROA(models.Model):
             subject_key = keypair.get_public(),
             sia         = (None, None, self.uri_from_key(keypair),
                            self.ca_detail.ca.parent.repository.rrdp_notification_uri))
-        self.roa = rpki.x509.ROA.build(self.asn,
-                                       rpki.resource_set.roa_prefix_set_ipv4(self.ipv4),
-                                       rpki.resource_set.roa_prefix_set_ipv6(self.ipv6),
-                                       keypair,
-                                       (self.cert,))
+        self.roa = yield publisher.rpkid.crypto_pool.build_roa(self.asn,
+                                                               self.ipv4,
+                                                               self.ipv6,
+                                                               keypair,
+                                                               (self.cert,))
         self.published = rpki.sundial.now()
         self.save()
 
@@ -2410,6 +2577,7 @@ class ROA(models.Model):
         self.save()
 
 
+    @tornado.gen.coroutine
     def revoke(self, publisher, regenerate = False, allow_failure = False):
         """
         Withdraw this ROA.
@@ -2424,23 +2592,31 @@ class ROA(models.Model):
 
         trace_call_chain()
         logger.debug("%s %r", "Regenerating" if regenerate else "Not regenerating", self)
-        old_ca_detail = self.ca_detail
-        old_obj = self.roa
-        old_cer = self.cert
-        old_uri = self.uri
-        if regenerate:
-            self.generate(publisher = publisher)
-        logger.debug("Withdrawing %r and revoking its EE cert", self)
-        RevokedCert.revoke(cert = old_cer, ca_detail = old_ca_detail)
-        publisher.queue(
-            uri        = old_uri,
-            old_obj    = old_obj,
-            repository = old_ca_detail.ca.parent.repository,
-            handler    = False if allow_failure else None)
-        if not regenerate:
-            self.delete()
+        lock = publisher.rpkid.object_lock(self)
+        with (yield lock.acquire()):
+            try:
+                self.refresh_from_db(fields = ("ca_detail", "cert", "roa"))
+            except ROA.DoesNotExist:
+                logger.debug("%r already withdrawn", self)
+                return
+            old_ca_detail = self.ca_detail
+            old_obj = self.roa
+            old_cer = self.cert
+            old_uri = self.uri
+            if regenerate:
+                yield self._generate(publisher = publisher)
+            logger.debug("Withdrawing %r and revoking its EE cert", self)
+            RevokedCert.revoke(cert = old_cer, ca_detail = old_ca_detail)
+            publisher.queue(
+                uri        = old_uri,
+                old_obj    = old_obj,
+                repository = old_ca_detail.ca.parent.repository,
+                handler    = False if allow_failure else None)
+            if not regenerate:
+                self.delete()
 
 
+    @tornado.gen.coroutine
     def regenerate(self, publisher):
         """
         Reissue this ROA.
@@ -2448,9 +2624,9 @@ class ROA(models.Model):
 
         trace_call_chain()
         if self.ca_detail is None:
-            self.generate(publisher = publisher)
+            yield self.generate(publisher = publisher)
         else:
-            self.revoke(publisher = publisher, regenerate = True)
+            yield self.revoke(publisher = publisher, regenerate = True)
 
 
     def uri_from_key(self, key):
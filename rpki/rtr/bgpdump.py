@@ -52,7 +52,7 @@ class PrefixPDU(rpki.rtr.generator.PrefixPDU):
             fields = line.split("|")
 
             # Parse prefix, including figuring out IP protocol version
-            cls = rpki.rtr.generator.IPv6PrefixPDU if ":" in fields[5] else rpki.rtr.generator.IPv4PrefixPDU
+            cls = IPv6PrefixPDU if ":" in fields[5] else IPv4PrefixPDU
             self = cls(version = min(rpki.rtr.pdus.PDU.version_map))
             self.timestamp = Timestamp(fields[1])
             p, l = fields[5].split("/")
@@ -90,6 +90,13 @@ class PrefixPDU(rpki.rtr.generator.PrefixPDU):
             raise IgnoreThisRecord
 
 
+class IPv4PrefixPDU(PrefixPDU, rpki.rtr.generator.IPv4PrefixPDU):
+    pass
+
+class IPv6PrefixPDU(PrefixPDU, rpki.rtr.generator.IPv6PrefixPDU):
+    pass
+
+
 class AXFRSet(rpki.rtr.generator.AXFRSet):
 
     serial = None
@@ -81,6 +81,7 @@ class CacheResponsePDU(rpki.rtr.pdus.CacheResponsePDU):
         if self.nonce != client.nonce:
             logging.debug("[Nonce changed, resetting]")
             client.cache_reset()
+        client.cache_response()
 
 @clone_pdu
 class EndOfDataPDUv0(rpki.rtr.pdus.EndOfDataPDUv0):
@@ -181,7 +182,23 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
     expire   = rpki.rtr.pdus.default_expire
     updated  = Timestamp(0)
 
+    # Number of buffered PDUs at which we flush to SQL without waiting
+    # for the end of the cache response.
+    batch_size = 10000
+
+    sql_insert = dict(
+        prefix    = "INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) VALUES (?, ?, ?, ?, ?)",
+        routerkey = "INSERT INTO routerkey (cache_id, asn, ski, key) VALUES (?, ?, ?, ?)")
+
+    sql_delete = dict(
+        prefix    = "DELETE FROM prefix WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
+        routerkey = "DELETE FROM routerkey WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)")
+
     def __init__(self, sock, proc, killsig, args, host = None, port = None):
+        self.full_load = False
+        self.pending = dict((table, {}) for table in self.sql_insert)
+        self.inserts = dict((table, []) for table in self.sql_insert)
+        self.deletes = dict((table, []) for table in self.sql_insert)
         self.killsig = killsig
         self.proc = proc
         self.args = args
@@ -286,6 +303,9 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.sql.text_factory = str
         cur = self.sql.cursor()
         cur.execute("PRAGMA foreign_keys = on")
+        if self.args.sql_wal:
+            cur.execute("PRAGMA journal_mode = WAL")
+            cur.execute("PRAGMA synchronous = NORMAL")
         if missing:
             cur.execute('''
                 CREATE TABLE cache (
@@ -356,6 +376,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         """
 
         self.serial = None
+        self.discard_pending()
         if self.sql:
             cur = self.sql.cursor()
             cur.execute("DELETE FROM prefix WHERE cache_id = ?", (self.cache_id,))
@@ -376,6 +397,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
         self.expire  = expire
         self.updated = Timestamp.now()
         if self.sql:
+            self.flush_pending()
             self.sql.execute("UPDATE cache SET"
                              " version = ?, serial = ?, nonce  = ?,"
                              " refresh = ?, retry  = ?, expire = ?,"
@@ -384,6 +406,66 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
                              (version, serial, nonce, refresh, retry, expire, int(self.updated), self.cache_id))
             self.sql.commit()
 
+    def cache_response(self):
+        """
+        Handle CacheResponsePDU actions.  A response to a client with no
+        serial number is a full load into empty tables.
+        """
+
+        self.full_load = self.serial is None
+
+    @staticmethod
+    def pending_keys(table, values):
+        """
+        Keys under which a buffered change can collide with another one.
+        Prefix deletion matches the exact row, but routerkey deletion
+        matches on ASN plus either SKI or key, so index both of those.
+        """
+
+        if table == "routerkey":
+            cache_id, asn, ski, key = values
+            return ((cache_id, asn, "ski", ski), (cache_id, asn, "key", key))
+        return (values,)
+
+    def queue_pending(self, table, values, announce):
+        """
+        Buffer one insertion or deletion.  If this touches rows a change
+        of the other kind already buffered would touch, flush first so
+        the two happen in order.
+        """
+
+        keys = self.pending_keys(table, values)
+        if any(self.pending[table].get(k, announce) != announce for k in keys):
+            self.flush_pending()
+        for k in keys:
+            self.pending[table][k] = announce
+        (self.inserts if announce else self.deletes)[table].append(values)
+        if len(self.inserts[table]) + len(self.deletes[table]) >= self.batch_size:
+            self.flush_pending()
+
+    def flush_pending(self):
+        """
+        Apply buffered changes with executemany().  Nothing commits until
+        end_of_data(), so one cache response is one transaction.  On a
+        full load we sort insertions into index order first, which keeps
+        SQLite appending to its B-trees instead of splitting pages.
+        """
+
+        for table in self.sql_insert:
+            if self.deletes[table]:
+                self.sql.executemany(self.sql_delete[table], self.deletes[table])
+            if self.inserts[table]:
+                if self.full_load:
+                    self.inserts[table].sort()
+                self.sql.executemany(self.sql_insert[table], self.inserts[table])
+        self.discard_pending()
+
+    def discard_pending(self):
+        for table in self.sql_insert:
+            self.pending[table].clear()
+            del self.inserts[table][:]
+            del self.deletes[table][:]
+
     def consume_prefix(self, prefix):
         """
         Handle one prefix PDU.
@@ -391,14 +473,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
 
         if self.sql:
             values = (self.cache_id, prefix.asn, str(prefix.prefix), prefix.prefixlen, prefix.max_prefixlen)
-            if prefix.announce:
-                self.sql.execute("INSERT INTO prefix (cache_id, asn, prefix, prefixlen, max_prefixlen) "
-                                 "VALUES (?, ?, ?, ?, ?)",
-                                 values)
-            else:
-                self.sql.execute("DELETE FROM prefix "
-                                 "WHERE cache_id = ? AND asn = ? AND prefix = ? AND prefixlen = ? AND max_prefixlen = ?",
-                                 values)
+            self.queue_pending("prefix", values, prefix.announce)
 
     def consume_routerkey(self, routerkey):
         """
@@ -409,14 +484,7 @@ class ClientChannel(rpki.rtr.channels.PDUChannel):
             values = (self.cache_id, routerkey.asn,
                       base64.urlsafe_b64encode(routerkey.ski).rstrip("="),
                       base64.b64encode(routerkey.key))
-            if routerkey.announce:
-                self.sql.execute("INSERT INTO routerkey (cache_id, asn, ski, key) "
-                                 "VALUES (?, ?, ?, ?)",
-                                 values)
-            else:
-                self.sql.execute("DELETE FROM routerkey "
-                                 "WHERE cache_id = ? AND asn = ? AND (ski = ? OR key = ?)",
-                                 values)
+            self.queue_pending("routerkey", values, routerkey.announce)
 
     def deliver_pdu(self, pdu):
         """
@@ -526,6 +594,7 @@ def argparse_setup(subparsers):
     subparser.add_argument("--sql-database", help = "filename for sqlite3 database of client state")
     subparser.add_argument("--force-version", type = int, choices = PDU.version_map, help = "force specific protocol version")
     subparser.add_argument("--reset-session", action = "store_true", help = "reset any existing session found in sqlite3 database")
+    subparser.add_argument("--sql-wal", action = "store_true", help = "use write-ahead logging in sqlite3 database")
     subparser.add_argument("protocol", choices = ("loopback", "tcp", "ssh", "tls"), help = "connection protocol")
     subparser.add_argument("host", nargs = "?", help = "server host")
     subparser.add_argument("port", nargs = "?", help = "server port")
@@ -23,7 +23,12 @@ Database generator for RPKI-RTR server (RFC 6810 et sequalia).
 
 import os
 import sys
+import mmap
 import glob
+import array
+import struct
+import cPickle
+import itertools
 import socket
 import base64
 import random
@@ -37,7 +42,7 @@ import rpki.rtr.server
 
 from rpki.rtr.channels import Timestamp
 
-from rpki.rcynicdb.iterator import authenticated_objects
+from rpki.rcynicdb.iterator import authenticated_objects, authenticated_digests
 
 class PrefixPDU(rpki.rtr.pdus.PrefixPDU):
     """
@@ -50,6 +55,8 @@ class PrefixPDU(rpki.rtr.pdus.PrefixPDU):
     IPv6PrefixPDU) depending on the syntax of its input text.
     """
 
+    __slots__ = ()
+
     @staticmethod
     def from_text(version, asn, addr):
         """
@@ -92,6 +99,8 @@ class IPv4PrefixPDU(PrefixPDU):
     IPv4 flavor of a prefix.
     """
 
+    __slots__ = ()
+
     pdu_type = 4
     address_byte_count = 4
 
@@ -100,6 +109,8 @@ class IPv6PrefixPDU(PrefixPDU):
     IPv6 flavor of a prefix.
     """
 
+    __slots__ = ()
+
     pdu_type = 6
     address_byte_count = 16
 
@@ -108,10 +119,7 @@ class RouterKeyPDU(rpki.rtr.pdus.RouterKeyPDU):
     Router Key PDU.
     """
 
-    announce = None
-    ski      = None
-    asn      = None
-    key      = None
+    __slots__ = ()
 
     @classmethod
     def from_text(cls, version, asn, gski, key):
@@ -287,10 +295,11 @@ class AXFRSet(PDUSet):
             except OSError, e:
                 sys.exit("Could not run %s: %s" % (scan_routercerts, e))
 
-        self.sort()
-        for i in xrange(len(self) - 2, -1, -1):
-            if self[i] == self[i + 1]:
-                del self[i + 1]
+        # Sort and deduplicate on the cached wire format rather than via
+        # PDU.__cmp__(), so that comparisons are just string compares.
+
+        self.sort(key = lambda p: p.to_pdu())
+        self[:] = [p for i, p in enumerate(self) if i == 0 or p.to_pdu() != self[i - 1].to_pdu()]
         return self
 
     @classmethod
@@ -392,10 +401,12 @@ class AXFRSet(PDUSet):
         len_new = len(new)
         i_old = i_new = 0
         while i_old < len_old and i_new < len_new:
-            if old[i_old] < new[i_new]:
+            p_old = old[i_old].to_pdu()
+            p_new = new[i_new].to_pdu()
+            if p_old < p_new:
                 f.write(old[i_old].to_pdu(announce = 0))
                 i_old += 1
-            elif old[i_old] > new[i_new]:
+            elif p_old > p_new:
                 f.write(new[i_new].to_pdu(announce = 1))
                 i_new += 1
             else:
@@ -417,6 +428,307 @@ class AXFRSet(PDUSet):
             logging.debug(p)
 
 
+def withdrawal(record, announce_offset):
+    """
+    Turn a wire format PDU with the announce flag set into the
+    corresponding withdrawal.
+    """
+
+    return record[:announce_offset] + "\x00" + record[announce_offset + 1:]
+
+
+class WireAXFRSet(AXFRSet):
+    """
+    AXFRSet holding sorted wire format PDUs as strings rather than PDU
+    objects, as produced by PDUCache.
+    """
+
+    def save_axfr(self):
+        """
+        Write AXFRSet to file with magic filename.
+        """
+
+        f = open(self.filename(), "wb")
+        for p in self:
+            f.write(p)
+        f.close()
+
+    def ixfr_delta(self, current, announced, withdrawn):
+        """
+        Work out the net change from the current AXFR file to this one
+        from the PDUs derived from objects which were added or removed
+        since then.  A candidate is only announced if it isn't already
+        in the current AXFR, and only withdrawn if nothing else in this
+        AXFRSet still produces it.  Returns a sorted list of (pdu,
+        announce) pairs, empty if the objects changed but the PDUs
+        didn't.
+        """
+
+        new = set(self)
+        changes = [(p, True)  for p in set(announced) if p not in current]
+        changes.extend((p, False) for p in set(withdrawn) if p not in new)
+        changes.sort()
+        return changes
+
+    def save_ixfr_delta(self, current, changes):
+        """
+        Write the IXFR from the current AXFR file to this one from the
+        net changes computed by .ixfr_delta().
+        """
+
+        pdu_map = rpki.rtr.pdus.PDU.version_map[self.version]
+        f = open("%d.ix.%d.v%d" % (self.serial, current.serial, self.version), "wb")
+        for p, announce in changes:
+            f.write(p if announce else withdrawal(p, pdu_map[ord(p[1])].announce_offset))
+        f.close()
+
+
+class PDUCache(object):
+    """
+    Persistent map from SHA-256 digests of the ROAs and certificates in
+    rcynic's output to the wire format PDUs derived from them, so that
+    each cronjob run only parses objects which are new since the last
+    run.  The cache also records the serial of the AXFR it produced,
+    so that we can tell whether the added and removed objects describe
+    the change from the current AXFR.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.filename = "pducache.v%d" % version
+        try:
+            with open(self.filename, "rb") as f:
+                self.serial, self.objects = cPickle.load(f)
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            self.serial, self.objects = None, {}
+        self.added = self.removed = self.announced = self.withdrawn = ()
+
+    def save(self, serial):
+        """
+        Record the serial number of the AXFR we just generated and write
+        the cache to disk.
+        """
+
+        self.serial = int(serial)
+        tmpfn = self.filename + ".%d.tmp" % os.getpid()
+        with open(tmpfn, "wb") as f:
+            cPickle.dump((self.serial, self.objects), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmpfn, self.filename)
+
+    def roa_pdus(self, roa):
+        roa.extractWithoutVerifying()
+        asn = roa.getASID()
+        return tuple(PrefixPDU.from_roa(version = self.version, asn = asn, prefix_tuple = prefix_tuple).to_pdu()
+                     for prefix_tuple in roa.prefixes)
+
+    def cer_pdus(self, cer):
+        eku = cer.getEKU()
+        if eku is None or rpki.oids.id_kp_bgpsec_router not in eku:
+            return ()
+        ski = cer.getSKI()
+        key = cer.getPublicKey().derWritePublic()
+        return tuple(RouterKeyPDU.from_certificate(version = self.version, asn = asn, ski = ski, key = key).to_pdu()
+                     for asn in cer.asns)
+
+    def scan_rcynic(self, rcynic_dir):
+        """
+        Update the cache from rcynic's output and return a WireAXFRSet
+        with a new serial number.  Objects added and removed since the
+        last scan are left in .added and .removed.
+        """
+
+        include_routercerts = RouterKeyPDU.pdu_type in rpki.rtr.pdus.PDU.version_map[self.version]
+        objects = {}
+
+        for uri, sha256, roa in authenticated_digests(rcynic_dir, uri_suffix = ".roa",
+                                                      class_map = AXFRSet.class_map, known = self.objects):
+            objects[sha256] = self.objects[sha256] if roa is None else self.roa_pdus(roa)
+
+        if include_routercerts:
+            for uri, sha256, cer in authenticated_digests(rcynic_dir, uri_suffix = ".cer",
+                                                          class_map = AXFRSet.class_map, known = self.objects):
+                objects[sha256] = self.objects[sha256] if cer is None else self.cer_pdus(cer)
+
+        self.added   = [sha256 for sha256 in objects      if sha256 not in self.objects]
+        self.removed = [sha256 for sha256 in self.objects if sha256 not in objects]
+        old_objects, self.objects = self.objects, objects
+
+        self.announced = [p for sha256 in self.added   for p in objects[sha256]]
+        self.withdrawn = [p for sha256 in self.removed for p in old_objects[sha256]]
+
+        pdus = WireAXFRSet(version = self.version)
+        pdus.serial = rpki.rtr.channels.Timestamp.now()
+        pdus.extend(sorted(set(p for ps in objects.itervalues() for p in ps)))
+        return pdus
+
+
+class AXFRFile(object):
+    """
+    Read-only, mmap()ed view of an AXFR file.
+
+    The on-disk AXFR format is just the sorted wire format PDUs, which
+    is what the server streams to routers.  Sorting on the wire format
+    groups records by PDU type, and prefix PDUs are fixed width, so the
+    file is a short sequence of fixed-record runs (plus one run of
+    variable length router keys).  We find the runs when we open the
+    file, after which we can count, search, iterate, and diff records
+    as string slices of the mapped buffer without ever building PDU
+    objects.
+    """
+
+    length_struct = struct.Struct("!L")
+
+    serial = None
+
+    def __init__(self, filename, version):
+        self.version = version
+        self.f = open(filename, "rb")
+        try:
+            self.buffer = mmap.mmap(self.f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            self.buffer = ""            # Can't mmap() an empty file
+        self.runs = []
+        pdu_map = rpki.rtr.pdus.PDU.version_map[version]
+        size = len(self.buffer)
+        pos = 0
+        while pos < size:
+            assert ord(self.buffer[pos]) == version
+            pdu_type = ord(self.buffer[pos + 1])
+            cls = pdu_map[pdu_type]
+            width = cls.pdu_length()
+            start = pos
+            offsets = None if width else array.array("L")
+            while pos < size and ord(self.buffer[pos + 1]) == pdu_type:
+                if width:
+                    pos += width
+                else:
+                    offsets.append(pos)
+                    pos += self.length_struct.unpack_from(self.buffer, pos + 4)[0]
+            assert pos == size or ord(self.buffer[pos + 1]) > pdu_type
+            if offsets is not None:
+                offsets.append(pos)
+            self.runs.append((pdu_type, start, pos, width, offsets, cls.announce_offset))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Open an AXFR file, parse filename to obtain version and serial.
+        """
+
+        fn1, fn2, fn3 = os.path.basename(filename).split(".")
+        assert fn1.isdigit() and fn2 == "ax" and fn3.startswith("v") and fn3[1:].isdigit()
+        self = cls(filename, int(fn3[1:]))
+        self.serial = rpki.rtr.channels.Timestamp(fn1)
+        return self
+
+    @classmethod
+    def load_current(cls, version):
+        """
+        Open current AXFR file.  Return None if can't.
+        """
+
+        serial = rpki.rtr.server.read_current(version)[0]
+        if serial is None:
+            return None
+        try:
+            return cls.load("%d.ax.v%d" % (serial, version))
+        except IOError:
+            return None
+
+    def close(self):
+        if not isinstance(self.buffer, str):
+            self.buffer.close()
+        self.f.close()
+
+    @staticmethod
+    def _run_length(run):
+        pdu_type, start, end, width, offsets, announce_offset = run
+        return (end - start) / width if width else len(offsets) - 1
+
+    @staticmethod
+    def _run_record(buffer, run, i):
+        pdu_type, start, end, width, offsets, announce_offset = run
+        if width:
+            return buffer[start + i * width : start + (i + 1) * width]
+        else:
+            return buffer[offsets[i] : offsets[i + 1]]
+
+    def __len__(self):
+        return sum(self._run_length(run) for run in self.runs)
+
+    def __iter__(self):
+        for run in self.runs:
+            for i in xrange(self._run_length(run)):
+                yield self._run_record(self.buffer, run, i)
+
+    def __contains__(self, pdu):
+        """
+        Binary search for a wire format PDU (with announce set).
+        """
+
+        if isinstance(pdu, rpki.rtr.pdus.PDU):
+            pdu = pdu.to_pdu()
+        for run in self.runs:
+            if run[0] == ord(pdu[1]):
+                lo, hi = 0, self._run_length(run)
+                while lo < hi:
+                    mid = (lo + hi) / 2
+                    if self._run_record(self.buffer, run, mid) < pdu:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                return lo < self._run_length(run) and self._run_record(self.buffer, run, lo) == pdu
+        return False
+
+    def same_as(self, pdus):
+        """
+        Check whether this file holds exactly the PDUs in an AXFRSet.
+        """
+
+        if pdus is None or len(pdus) != len(self):
+            return False
+        return all(r == (p if isinstance(p, str) else p.to_pdu()) for r, p in itertools.izip(self, pdus))
+
+    def _announced(self):
+        """
+        Iterate over (record, announce_offset) pairs.
+        """
+
+        for run in self.runs:
+            for i in xrange(self._run_length(run)):
+                yield self._run_record(self.buffer, run, i), run[5]
+
+    def save_ixfr(self, other):
+        """
+        Compare this AXFR file with an older one and write the resulting
+        IXFR file, working directly on the mapped buffers.  Withdrawals
+        are just the old records with the announce flag cleared.
+        """
+
+        f = open("%d.ix.%d.v%d" % (self.serial, other.serial, self.version), "wb")
+        old = other._announced()
+        new = self._announced()
+        o = next(old, None)
+        n = next(new, None)
+        while o is not None and n is not None:
+            if o[0] < n[0]:
+                f.write(withdrawal(*o))
+                o = next(old, None)
+            elif o[0] > n[0]:
+                f.write(n[0])
+                n = next(new, None)
+            else:
+                o = next(old, None)
+                n = next(new, None)
+        while o is not None:
+            f.write(withdrawal(*o))
+            o = next(old, None)
+        while n is not None:
+            f.write(n[0])
+            n = next(new, None)
+        f.close()
+
+
 class IXFRSet(PDUSet):
     """
     Object representing an incremental set of PDUs, that is, the
@@ -525,15 +837,53 @@ def cronjob_main(args):
                 logging.debug("# Deleting old file %s, timestamp %s", f, t)
                 os.unlink(f)
 
-        pdus = rpki.rtr.generator.AXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
-        if pdus == rpki.rtr.generator.AXFRSet.load_current(version):
+        if args.incremental and args.scan_roas is None and args.scan_routercerts is None:
+            cache = rpki.rtr.generator.PDUCache(version)
+            pdus = cache.scan_rcynic(args.rcynic_dir)
+        else:
+            cache = None
+            pdus = rpki.rtr.generator.AXFRSet.parse_rcynic(args.rcynic_dir, version, args.scan_roas, args.scan_routercerts)
+
+        current = rpki.rtr.generator.AXFRFile.load_current(version)
+
+        # If the cache produced the current AXFR, the objects added and
+        # removed since then tell us everything we need to know about
+        # the change, otherwise fall back to comparing whole AXFRs.
+
+        delta = cache is not None and current is not None and cache.serial == current.serial
+
+        if current is None:
+            unchanged = False
+        elif delta:
+            changes = pdus.ixfr_delta(current, cache.announced, cache.withdrawn)
+            unchanged = not changes
+        else:
+            unchanged = current.same_as(pdus)
+
+        if unchanged:
             logging.debug("# No change, new serial not needed")
+            if cache is not None:
+                cache.save(current.serial)
+            current.close()
             continue
         pdus.save_axfr()
+        new = rpki.rtr.generator.AXFRFile.load(pdus.filename())
         for axfr in glob.iglob("*.ax.v%d" % version):
-            if axfr != pdus.filename():
-                pdus.save_ixfr(rpki.rtr.generator.AXFRSet.load(axfr))
+            if axfr == pdus.filename():
+                continue
+            if delta and axfr == current.f.name:
+                logging.debug("# Writing IXFR from %d changed PDUs", len(changes))
+                pdus.save_ixfr_delta(current, changes)
+            else:
+                old = rpki.rtr.generator.AXFRFile.load(axfr)
+                new.save_ixfr(old)
+                old.close()
+        new.close()
+        if current is not None:
+            current.close()
         pdus.mark_current(args.force_zero_nonce)
+        if cache is not None:
+            cache.save(pdus.serial)
 
         logging.debug("# New serial is %d (%s)", pdus.serial, pdus.serial)
 
@@ -580,6 +930,8 @@ def argparse_setup(subparsers):
     subparser.add_argument("--scan-roas", help = "specify an external scan_roas program")
     subparser.add_argument("--scan-routercerts", help = "specify an external scan_routercerts program")
     subparser.add_argument("--force_zero_nonce", action = "store_true", help = "force nonce value of zero")
+    subparser.add_argument("--incremental", action = "store_true",
+                           help = "only parse objects which changed since the last run, using a persistent cache")
     subparser.add_argument("rcynic_dir", nargs = "?", help = "directory containing validated rcynic output tree")
     subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
 
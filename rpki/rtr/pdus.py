@@ -111,9 +111,13 @@ class PDU(object):
     Base PDU.  Real PDUs are subclasses of this class.
     """
 
-    version_map = {0 : {}, 1 : {}}        # Updated by @wire_pdu
+    # Data PDUs can number in the millions, so we use __slots__ for
+    # them and their ancestors.  Subclasses which don't declare
+    # __slots__ get a __dict__ as usual.
+
+    __slots__ = ("version", "_pdu")       # _pdu is cached when first generated
 
-    _pdu = None                           # Cached when first generated
+    version_map = {0 : {}, 1 : {}}        # Updated by @wire_pdu
 
     header_struct = struct.Struct("!BB2xL")
 
@@ -122,6 +126,7 @@ class PDU(object):
     def __init__(self, version):
         assert version in self.version_map
         self.version = version
+        self._pdu = None
 
     def __cmp__(self, other):
         return cmp(self.to_pdu(), other.to_pdu())
@@ -145,7 +150,7 @@ class PDU(object):
         if not reader.ready():
             return None
         assert reader.available() >= cls.header_struct.size
-        version, pdu_type, length = cls.header_struct.unpack(reader.buffer[:cls.header_struct.size])
+        version, pdu_type, length = cls.header_struct.unpack(reader.peek(cls.header_struct.size))
         reader.check_version(version)
         if pdu_type not in cls.version_map[version]:
             raise UnsupportedPDUType(
@@ -424,9 +429,20 @@ class PrefixPDU(PDU):
     IPv6PrefixPDU) depending on the syntax of its input text.
     """
 
+    __slots__ = ("asn", "prefix", "prefixlen", "max_prefixlen", "announce")
+
     header_struct = struct.Struct("!BB2xLBBBx")
     asnum_struct = struct.Struct("!L")
     address_byte_count = 0
+    announce_offset = 8                   # Offset of announce flag in wire format
+
+    @classmethod
+    def pdu_length(cls):
+        """
+        Length of this fixed-size PDU in wire format.
+        """
+
+        return cls.header_struct.size + cls.address_byte_count + cls.asnum_struct.size
 
     def __init__(self, version):
         super(PrefixPDU, self).__init__(version)
@@ -508,6 +524,8 @@ class IPv4PrefixPDU(PrefixPDU):
     IPv4 flavor of a prefix.
     """
 
+    __slots__ = ()
+
     pdu_type = 4
     address_byte_count = 4
 
@@ -517,6 +535,8 @@ class IPv6PrefixPDU(PrefixPDU):
     IPv6 flavor of a prefix.
     """
 
+    __slots__ = ()
+
     pdu_type = 6
     address_byte_count = 16
 
@@ -526,9 +546,20 @@ class RouterKeyPDU(PDU):
     Router Key PDU.
     """
 
+    __slots__ = ("announce", "ski", "asn", "key")
+
     pdu_type = 9
 
     header_struct = struct.Struct("!BBBxL20sL")
+    announce_offset = 2                   # Offset of announce flag in wire format
+
+    @classmethod
+    def pdu_length(cls):
+        """
+        Router key PDUs are variable length.
+        """
+
+        return None
 
     def __init__(self, version):
         super(RouterKeyPDU, self).__init__(version)
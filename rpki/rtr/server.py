@@ -23,11 +23,13 @@ Server implementation for the RPKI-RTR protocol (RFC 6810 et sequalia).
 
 import os
 import sys
+import mmap
 import errno
 import socket
 import signal
 import logging
 import asyncore
+import collections
 import rpki.POW
 import rpki.oids
 import rpki.rtr.pdus
@@ -57,10 +59,10 @@ class PDU(rpki.rtr.pdus.PDU):
         fn2 = os.path.splitext(filename)[1]
         assert fn2.startswith(".v") and fn2[2:].isdigit() and int(fn2[2:]) == server.version
 
-        f = open(filename, "rb")
+        payload = payload_cache.get(filename)
         server.push_pdu(CacheResponsePDU(version = server.version,
                                          nonce   = server.current_nonce))
-        server.push_file(f)
+        server.push_payload(payload)
         server.push_pdu(EndOfDataPDU(version = server.version,
                                      serial  = server.current_serial,
                                      nonce   = server.current_nonce,
@@ -159,7 +161,7 @@ class ErrorReportPDU(rpki.rtr.pdus.ErrorReportPDU):
         server.logger.error(self)
         if self.errno in self.fatal:
             server.logger.error("[Shutting down due to reported fatal protocol error]")
-            sys.exit(1)
+            server.shutdown()
 
 
 def read_current(version):
@@ -193,17 +195,60 @@ def write_current(serial, nonce, version):
     os.rename(tmpfn, curfn)
 
 
-class FileProducer(object):
+class PayloadCache(object):
+    """
+    Cache of read-only memory maps of AXFR and IXFR files.  Sessions
+    which send the same file share one mapping, and since the mapping
+    is backed by the page cache, so do forked session processes: nobody
+    holds a private copy of the data.  Filenames include the serial
+    numbers, so they are the whole key.  We keep the few most recently
+    used maps; an evicted map stays valid for as long as a producer
+    still holds it.
+    """
+
+    def __init__(self, size = 16):
+        self.size = size
+        self.payloads = collections.OrderedDict()
+
+    def get(self, filename):
+        """
+        Return a read-only map of a file's content, mapping it if we
+        don't already have it.  Caller should catch IOError.
+        """
+
+        try:
+            payload = self.payloads.pop(filename)
+        except KeyError:
+            with open(filename, "rb") as f:
+                if os.fstat(f.fileno()).st_size > 0:
+                    payload = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+                else:
+                    payload = ""
+            while len(self.payloads) >= self.size:
+                self.payloads.popitem(last = False)
+        self.payloads[filename] = payload
+        return payload
+
+payload_cache = PayloadCache()
+
+
+class PayloadProducer(object):
     """
-    File-based producer object for asynchat.
+    Producer object for asynchat which hands out read-only buffer()
+    views of a shared payload, so that sending it doesn't copy it.
     """
 
-    def __init__(self, handle, buffersize):
-        self.handle = handle
+    def __init__(self, payload, buffersize):
+        self.payload = payload
         self.buffersize = buffersize
+        self.offset = 0
 
     def more(self):
-        return self.handle.read(self.buffersize)
+        if self.offset >= len(self.payload):
+            return ""
+        b = buffer(self.payload, self.offset, self.buffersize)
+        self.offset += self.buffersize
+        return b
 
 
 class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
@@ -230,13 +275,13 @@ class ServerWriteChannel(rpki.rtr.channels.PDUChannel):
 
         return False
 
-    def push_file(self, f):
+    def push_payload(self, payload):
         """
-        Write content of a file to stream.
+        Write a cached payload to stream.
         """
 
         try:
-            self.push_with_producer(FileProducer(f, self.ac_out_buffer_size))
+            self.push_with_producer(PayloadProducer(payload, self.ac_out_buffer_size))
         except OSError, e:
             if e.errno != errno.EAGAIN:
                 raise
@@ -292,12 +337,12 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
 
         return self.writer.push_pdu(pdu)
 
-    def push_file(self, f):
+    def push_payload(self, payload):
         """
         Redirect to writer channel.
         """
 
-        return self.writer.push_file(f)
+        return self.writer.push_payload(payload)
 
     def deliver_pdu(self, pdu):
         """
@@ -325,6 +370,13 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
         old_serial = self.current_serial
         return old_serial != self.get_serial()
 
+    def shutdown(self):
+        """
+        Shut down after a fatal protocol error.
+        """
+
+        sys.exit(1)
+
     def notify(self, data = None, force = False):
         """
         Cronjob instance kicked us: check whether our serial number has
@@ -344,6 +396,115 @@ class ServerChannel(rpki.rtr.channels.PDUChannel):
             self.logger.debug("Cronjob kicked me but I see no serial change, ignoring")
 
 
+class SocketServerChannel(ServerChannel):
+    """
+    ServerChannel for one TCP connection in a listener process which
+    serves many connections from a single event loop.  Rather than
+    reading stdin and writing stdout, this talks directly to its socket,
+    and rather than exiting when done, it just closes.
+    """
+
+    def __init__(self, sock, listener, logger, refresh, retry, expire):
+        rpki.rtr.channels.PDUChannel.__init__(self, root_pdu_class = PDU, sock = sock)
+        self.listener = listener
+        self.logger = logger
+        self.refresh = refresh
+        self.retry = retry
+        self.expire = expire
+        self.get_serial()
+        self.start_new_pdu()
+        self.listener.channels.add(self)
+
+    def writable(self):
+        return rpki.rtr.channels.PDUChannel.writable(self)
+
+    def push(self, data):
+        return rpki.rtr.channels.PDUChannel.push(self, data)
+
+    def push_with_producer(self, producer):
+        return rpki.rtr.channels.PDUChannel.push_with_producer(self, producer)
+
+    def push_pdu(self, pdu):
+        return rpki.rtr.channels.PDUChannel.push_pdu(self, pdu)
+
+    def push_payload(self, payload):
+        """
+        Write a cached payload to stream.
+        """
+
+        return self.push_with_producer(PayloadProducer(payload, self.ac_out_buffer_size))
+
+    def shutdown(self):
+        self.close_when_done()
+
+    def close(self):
+        self.listener.channels.discard(self)
+        rpki.rtr.channels.PDUChannel.close(self)
+
+    def handle_close(self):
+        self.logger.debug("[Client closed channel]")
+        self.close()
+
+    def handle_error(self):
+        self.logger.exception("[Unhandled exception, closing connection]")
+        self.close()
+
+
+class ListenerChannel(asyncore.dispatcher, object):
+    """
+    asyncore dispatcher for a listening TCP socket, creating a
+    SocketServerChannel for each connection.  Kicks from the cronjob
+    arrive once per listener process and fan out to every channel.
+    """
+
+    def __init__(self, sock, args):
+        asyncore.dispatcher.__init__(self, sock)            # Old-style class
+        self.accepting = True                               # Socket is already listening
+        self.args = args
+        self.channels = set()
+        self.logger = logging.LoggerAdapter(logging.root, dict(connection = "/listener/%d" % os.getpid()))
+
+    def writable(self):
+        """
+        This socket is never writable.
+        """
+
+        return False
+
+    def handle_accept(self):
+        """
+        Accept a new connection.  Other worker processes listening on
+        the same socket may have beaten us to it.
+        """
+
+        try:
+            pair = self.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                return
+            raise
+        if pair is None:
+            return
+        sock, ai = pair
+        host, port = ai[:2]
+        tag = "/tcp/%s.%s" % (host, port) if ":" in host else "/tcp/%s:%s" % (host, port)
+        logger = logging.LoggerAdapter(logging.root, dict(connection = tag))
+        logger.debug("[Starting]")
+        SocketServerChannel(sock = sock, listener = self, logger = logger,
+                            refresh = self.args.refresh, retry = self.args.retry, expire = self.args.expire)
+
+    def notify(self, data = None):
+        """
+        Cronjob kicked us, pass the kick along to every connection.
+        """
+
+        for channel in tuple(self.channels):
+            channel.notify(data)
+
+    def handle_error(self):
+        self.logger.exception("[Unhandled exception in listener]")
+
+
 class KickmeChannel(asyncore.dispatcher, object):
     """
     asyncore dispatcher for the PF_UNIX socket that cronjob mode uses to
@@ -512,7 +673,14 @@ def listener_main(args):
 
     # Perhaps we should daemonize?  Deal with that later.
 
-    # server_main() handles args.rpki_rtr_dir.
+    # server_main() handles args.rpki_rtr_dir, unless we're running
+    # worker processes, in which case there's no server_main().
+
+    if args.workers > 0 and args.rpki_rtr_dir:
+        try:
+            os.chdir(args.rpki_rtr_dir)
+        except OSError, e:
+            sys.exit("Couldn't chdir(%r): %s" % (args.rpki_rtr_dir, e))
 
     listener = None
     try:
@@ -528,8 +696,11 @@ def listener_main(args):
     except AttributeError:
         pass
     listener.bind(("", args.port))
-    listener.listen(5)
+    listener.listen(128 if args.workers > 0 else 5)
     logging.debug("[Listening on port %s]", args.port)
+    if args.workers > 0:
+        listener_workers(listener, args)
+        return
     while True:
         try:
             s, ai = listener.accept()
@@ -557,6 +728,58 @@ def listener_main(args):
                 break
 
 
+def listener_worker(listener, args):
+    """
+    Body of one listener worker process: serve every connection we
+    accept from one asyncore loop, with one kickme socket.
+    """
+
+    kickme = None
+    try:
+        listener.setblocking(0)
+        server = ListenerChannel(sock = listener, args = args)
+        kickme = KickmeChannel(server = server)
+        asyncore.loop(timeout = None, use_poll = True)
+    except KeyboardInterrupt:
+        sys.exit(0)
+    finally:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if kickme is not None:
+            kickme.cleanup()
+
+
+def listener_workers(listener, args):
+    """
+    Run a fixed pool of listener worker processes sharing one listening
+    socket, replacing any which exit.  With a single worker, just run
+    it in this process.
+    """
+
+    if args.workers == 1:
+        return listener_worker(listener, args)
+
+    workers = set()
+    try:
+        while True:
+            while len(workers) < args.workers:
+                pid = os.fork()
+                if pid == 0:
+                    listener_worker(listener, args)
+                    sys.exit()
+                logging.debug("[Spawned worker %d]", pid)
+                workers.add(pid)
+            pid, status = os.wait()
+            logging.debug("[Worker %s exited with status 0x%x]", pid, status)
+            workers.discard(pid)
+    except KeyboardInterrupt:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except OSError:
+                pass
+        sys.exit(0)
+
+
 def argparse_setup(subparsers):
     """
     Set up argparse stuff for commands in this module.
@@ -591,5 +814,7 @@ def argparse_setup(subparsers):
     subparser.add_argument("--refresh", type = refresh, help = "override default refresh timer")
     subparser.add_argument("--retry",   type = retry,   help = "override default retry timer")
     subparser.add_argument("--expire",  type = expire,  help = "override default expire timer")
+    subparser.add_argument("--workers", type = int, default = 0,
+                           help = "serve connections from this many worker processes rather than forking per connection")
     subparser.add_argument("port",      type = int,     help = "TCP port on which to listen")
     subparser.add_argument("rpki_rtr_dir", nargs = "?", help = "directory containing RPKI-RTR database")
@@ -249,6 +249,12 @@ class DER_object(object):
     # Rate-limiting interval between whines about Auto_update objects.
     failure_threshold = rpki.sundial.timedelta(minutes = 5)
 
+    ## @var auto_update_interval
+    # Minimum interval in seconds between checks of an Auto_update
+    # object's file, so that we don't stat() BPKI certificates and keys
+    # on every use.  Zero means check every time.
+    auto_update_interval = 5
+
     def empty(self):
         """
         Test whether this object is empty.
@@ -266,6 +272,7 @@ class DER_object(object):
         self.filename = None
         self.timestamp = None
         self.lastfail = None
+        self.lastcheck = None
 
     def __init__(self, **kw):
         """
@@ -325,6 +332,9 @@ class DER_object(object):
 
         if self.filename is None:
             return
+        checked = time.time()
+        if self.lastcheck is not None and checked < self.lastcheck + self.auto_update_interval:
+            return
         try:
             filename = self.filename
             timestamp = os.stat(self.filename).st_mtime
@@ -348,6 +358,7 @@ class DER_object(object):
             self.lastfail = now
         else:
             self.lastfail = None
+        self.lastcheck = checked
 
     @property
     def mtime(self):
@@ -2052,14 +2063,7 @@ class XML_CMS_object(Wrapped_CMS_object):
         recent, otherwise returns the new timestamp.
         """
 
-        new_timestamp = self.get_signingTime()
-        if timestamp is not None and timestamp > new_timestamp:
-            if context:
-                context = " (" + " ".join(context) + ")"
-            raise rpki.exceptions.CMSReplay(
-                "CMS replay: last message %s, this message %s%s" % (
-                    timestamp, new_timestamp, context))
-        return new_timestamp
+        return check_replay_timestamp(self.get_signingTime(), timestamp, *context)
 
     def check_replay_sql(self, obj, *context):
         """
@@ -2068,8 +2072,36 @@ class XML_CMS_object(Wrapped_CMS_object):
         timestamp back in that same field.
         """
 
-        obj.last_cms_timestamp = self.check_replay(obj.last_cms_timestamp, *context)
-        obj.save()
+        check_replay_timestamp_sql(self.get_signingTime(), obj, *context)
+
+def check_replay_timestamp(new_timestamp, timestamp, *context):
+    """
+    Check a CMS signing-time against a recorded timestamp.  Raises an
+    exception if the recorded timestamp is more recent, otherwise
+    returns the new timestamp.
+    """
+
+    if timestamp is not None and timestamp > new_timestamp:
+        if context:
+            context = " (" + " ".join(context) + ")"
+        raise rpki.exceptions.CMSReplay(
+            "CMS replay: last message %s, this message %s%s" % (
+                timestamp, new_timestamp, context))
+    return new_timestamp
+
+def check_replay_timestamp_sql(new_timestamp, obj, *context):
+    """
+    Like check_replay_timestamp() but against the "last_cms_timestamp"
+    field of an SQL object.  The recorded timestamp is re-read from the
+    database and only that one column is written back, so that we
+    neither act on a stale copy of obj nor clobber other changes to its
+    row.
+    """
+
+    q = type(obj).objects.filter(pk = obj.pk)
+    timestamp = q.values_list("last_cms_timestamp", flat = True).get()
+    obj.last_cms_timestamp = check_replay_timestamp(new_timestamp, timestamp, *context)
+    q.update(last_cms_timestamp = obj.last_cms_timestamp)
 
 class SignedReferral(XML_CMS_object):
     encoding = "us-ascii"